@@ -1,6 +1,5 @@
 '''Provides configuration for pyromanager'''
 import os
-import subprocess
 import ConfigParser
 
 DEFAULT_RC = os.path.expanduser( "~/.pyromgr.rc" )
@@ -18,12 +17,13 @@ LOCATIONS = {
     22 : ( 'Korea'       , 'KOR'   , 'K' ),
 }
 
+# Lowercased LOCATIONS aliases mapped to their codes
+LOCATION_CODES = dict( ( alias.lower(), location_id ) for
+        ( location_id, aliases ) in LOCATIONS.iteritems() for alias in aliases )
+
 def region_code( name ):
     '''Translates region name to it's code (int)'''
-    for ( location_id, aliases ) in LOCATIONS.iteritems():
-        if name.lower() in [ x.lower() for x in aliases ]:
-            return location_id
-    return None
+    return LOCATION_CODES.get( name.lower() )
 
 def region_name( location_id, return_type=1 ):
     '''Translates region code to it's name(str)'''
@@ -40,18 +40,22 @@ def region_name( location_id, return_type=1 ):
 
     return result
 
-def is_bin_available( binfile ):
-    '''Determine if binary is somewhere in $PATH'''
-    exists = True
-    try:
-        chk = subprocess.Popen( [ binfile ], stdout = subprocess.PIPE,
-                stderr = subprocess.PIPE )
-        if chk.wait() == 127:
-            exists = False
-    except OSError:
-        exists = False
+_BIN_CACHE = {}
 
-    return exists
+def is_bin_available( binfile ):
+    '''Determine if binary is somewhere in $PATH, results are cached per
+    $PATH value'''
+    search_path = os.environ.get( 'PATH', os.defpath )
+    key = ( search_path, binfile )
+    if key not in _BIN_CACHE:
+        _BIN_CACHE[key] = False
+        for directory in search_path.split( os.pathsep ):
+            bin_path = os.path.join( directory or os.curdir, binfile )
+            if os.path.isfile( bin_path ) and os.access( bin_path, os.X_OK ):
+                _BIN_CACHE[key] = True
+                break
+
+    return _BIN_CACHE[key]
 
 class Config:
     '''Contais all the settings for pyromanager'''
@@ -107,8 +111,7 @@ class Config:
 
     @property
     def tmp_dir( self ):
-        '''Temporary dir, used to temporary extract archives into it to parse
-        nds files'''
+        '''Temporary dir, downloaded dat updates are unpacked into it'''
         return self._paths['tmp_dir']
 
     @property
@@ -138,7 +141,7 @@ class Config:
             self._extensions = [ 'nds', 'zip' ]
             if is_bin_available( '7z' ):
                 self._extensions.append( '7z' )
-            if is_bin_available( 'rar' ):
+            if is_bin_available( 'unrar' ):
                 self._extensions.append( 'rar' )
 
         return self._extensions
@@ -1,21 +1,106 @@
 '''Provides interfaces to databases'''
 import re, os, time
-import urllib2
 import sqlite3
 import logging
 from rom import mkdir, strip_name, Zip
-from xml.dom import minidom
+
+SCHEMA_VERSION = 4
+# Local rom columns followed by known rom columns, see SQLdb.local_roms
+LOCAL_ROM_COLUMNS = 'local.release_id, local.path, local.size, local.crc, ' + \
+        'known.id, known.name, known.publisher, known.released_by, ' + \
+        'known.region, known.search_name'
+# Sort keys accepted by SQLdb.iter_local_roms
+SORT_COLUMNS = {
+    'id'     : 'local.id',
+    'relid'  : 'local.release_id',
+    'name'   : 'known.name',
+    'region' : 'known.region',
+    'path'   : 'local.path',
+    'size'   : 'local.size',
+    'crc'    : 'local.crc',
+}
+
+# Schema changes applied on top of the tables from _create_tables, indexed by
+# the schema version they bring the database to.
+MIGRATIONS = {
+    1 : [
+        'CREATE INDEX IF NOT EXISTS known_crc ON known ( crc );',
+        'CREATE INDEX IF NOT EXISTS local_release_id ON local ( release_id );',
+        'CREATE INDEX IF NOT EXISTS local_size ON local ( size );',
+        'CREATE INDEX IF NOT EXISTS local_crc ON local ( crc );',
+    ],
+    2 : [
+        'CREATE TABLE IF NOT EXISTS fingerprints ' + \
+        '(path TEXT,' + \
+        'member TEXT,' + \
+        'size NUMERIC,' + \
+        'mtime_ns NUMERIC,' + \
+        'inode NUMERIC,' + \
+        'device NUMERIC,' + \
+        'nds_size NUMERIC,' + \
+        'crc NUMERIC,' + \
+        'PRIMARY KEY( path, member ) ON CONFLICT REPLACE);',
+    ],
+    3 : [
+        'CREATE TABLE IF NOT EXISTS pending ' + \
+        '(path TEXT PRIMARY KEY ON CONFLICT REPLACE,' + \
+        'search_name TEXT,' + \
+        'size NUMERIC,' + \
+        'crc NUMERIC);',
+    ],
+    4 : [
+        'CREATE TABLE IF NOT EXISTS archives ' + \
+        '(path TEXT PRIMARY KEY ON CONFLICT REPLACE,' + \
+        'size NUMERIC,' + \
+        'mtime_ns NUMERIC);',
+        'CREATE TABLE IF NOT EXISTS archive_members ' + \
+        '(path TEXT,' + \
+        'member TEXT,' + \
+        'size NUMERIC,' + \
+        'crc NUMERIC);',
+        'CREATE INDEX IF NOT EXISTS archive_members_path ' + \
+        'ON archive_members ( path );',
+    ],
+}
+# Trigram full-text index over search_name, kept in sync with its table by
+# triggers. Lets LIKE '%...%' name searches use an index.
+NAME_INDEX = [
+    "CREATE VIRTUAL TABLE %(table)s_names USING fts5( search_name, " + \
+        "content = '%(table)s', content_rowid = 'id', tokenize = 'trigram' );",
+    "CREATE TRIGGER %(table)s_names_insert AFTER INSERT ON %(table)s " + \
+        "BEGIN INSERT INTO %(table)s_names ( rowid, search_name ) " + \
+        "VALUES ( new.id, new.search_name ); END;",
+    "CREATE TRIGGER %(table)s_names_delete AFTER DELETE ON %(table)s " + \
+        "BEGIN INSERT INTO %(table)s_names ( %(table)s_names, rowid, " + \
+        "search_name ) VALUES ( 'delete', old.id, old.search_name ); END;",
+    "CREATE TRIGGER %(table)s_names_update AFTER UPDATE ON %(table)s " + \
+        "BEGIN INSERT INTO %(table)s_names ( %(table)s_names, rowid, " + \
+        "search_name ) VALUES ( 'delete', old.id, old.search_name ); " + \
+        "INSERT INTO %(table)s_names ( rowid, search_name ) " + \
+        "VALUES ( new.id, new.search_name ); END;",
+    "INSERT INTO %(table)s_names ( %(table)s_names ) VALUES ( 'rebuild' );",
+]
 
 class SQLdb():
     '''Interface for sqlite3 database'''
     def __init__( self, db_file = None ):
         mkdir( os.path.dirname( db_file ) )
+        self.db_file  = db_file
         # TODO: check reeeeeeeeeeeally carefully if this is safe thing to do.
         self.database = sqlite3.connect( db_file, check_same_thread = False )
+        # INSERT OR REPLACE has to fire delete triggers to keep name index
+        self.database.execute( 'PRAGMA recursive_triggers = ON' )
+        self.name_index = False
+        self._create_tables()
 
     def __del__( self ):
         self.database.close()
 
+    def connect( self ):
+        '''Returns new SQLdb on the same file with a connection of its own,
+        for use by another thread'''
+        return SQLdb( self.db_file )
+
     def _create_tables( self ):
         '''Creates tables if they don't exist'''
         cursor = self.database.cursor()
@@ -45,20 +130,107 @@ class SQLdb():
             'val TEXT );'
         )
         cursor.close()
+        self._migrate()
+        self._create_name_index()
         self.save()
 
-    def import_known( self, provider ):
-        '''Imports roms given by provider'''
-        self._create_tables()
+    def _create_name_index( self ):
+        '''Creates name indexes for known and local tables if sqlite supports
+        fts5 with trigram tokenizer, plain LIKE scans are used otherwise'''
+        cursor = self.database.cursor()
+        try:
+            for table in ( 'known', 'local' ):
+                if not cursor.execute(
+                    'SELECT name FROM sqlite_master WHERE name = ?',
+                    ( '%s_names' % table, )
+                ).fetchone():
+                    for query in NAME_INDEX:
+                        cursor.execute( query % { 'table' : table } )
+            self.name_index = True
+        except sqlite3.OperationalError as exc:
+            log = logging.getLogger( 'pyromgr' )
+            log.debug( 'Name index is not available: %s' % exc )
+        cursor.close()
+
+    def _name_match( self, table, name ):
+        '''Returns sql condition and parameters matching search_name'''
+        search_name = '%' + re.sub( r"\s", '%', name ) + '%'
+        condition   = '%s.search_name LIKE ?' % table
+        params      = [ search_name ]
+        if self.name_index:
+            condition = '%s.id IN ( SELECT rowid FROM %s_names ' % ( table,
+                    table ) + 'WHERE search_name LIKE ? ) AND ' + condition
+            params.append( search_name )
+        return ( condition, params )
+
+    def _migrate( self ):
+        '''Brings schema of existing database up to SCHEMA_VERSION'''
+        cursor = self.database.cursor()
+        for version in range( self.schema_version + 1, SCHEMA_VERSION + 1 ):
+            for query in MIGRATIONS[version]:
+                cursor.execute( query )
+            cursor.execute(
+                'INSERT OR REPLACE INTO db_info VALUES(?,?)',
+                ( 'schema_version', '%d' % version )
+            )
+        cursor.close()
 
+    @property
+    def schema_version( self ):
+        '''Returns schema version of the database'''
+        version = 0
         cursor = self.database.cursor()
+        returned = cursor.execute(
+            'SELECT val FROM db_info WHERE key = "schema_version"',
+        ).fetchone()
+        if returned:
+            version = int( returned[0] )
+        cursor.close()
+        return version
+
+    def import_known( self, provider, force = False ):
+        '''Imports roms given by provider, only new and changed rows are
+        written. Returns ( added, changed, unchanged ) counts'''
+        self._create_tables()
+
+        cursor  = self.database.cursor()
+        version = getattr( provider, 'dat_version', None )
+        if version and not force and version == self.dat_version:
+            unchanged = cursor.execute(
+                'SELECT COUNT(*) FROM known' ).fetchone()[0]
+            self.updated()
+            cursor.close()
+            return ( 0, 0, unchanged )
+
+        known = dict( ( row[0], row ) for row in cursor.execute(
+            'SELECT id, name, crc, publisher, released_by, region, ' + \
+            'search_name FROM known' ) )
+        ( added, changed, unchanged ) = ( 0, 0, 0 )
+        new_rows = []
         for data in provider:
+            current = known.get( data[0] )
+            if current is None:
+                added += 1
+            elif current != tuple( data ):
+                changed += 1
+            else:
+                unchanged += 1
+                continue
+            new_rows.append( data )
+        del known
+
+        cursor.executemany(
+            'INSERT OR REPLACE INTO known VALUES(?,?,?,?,?,?,?)',
+            new_rows
+        )
+        if version:
             cursor.execute(
-                'INSERT OR REPLACE INTO known VALUES(?,?,?,?,?,?,?)',
-                data
+                'INSERT OR REPLACE INTO db_info VALUES(?,?)',
+                ( 'dat_version', version )
             )
         self.updated()
         cursor.close()
+        return ( added, changed, unchanged )
 
     def updated( self ):
         '''Sets db_info.u_time to current time'''
@@ -71,6 +243,19 @@ class SQLdb():
         )
         cursor.close()
 
+    @property
+    def dat_version( self ):
+        '''Returns version of the last imported dat'''
+        version = None
+        cursor = self.database.cursor()
+        returned = cursor.execute(
+            'SELECT val FROM db_info WHERE key = "dat_version"',
+        ).fetchone()
+        if returned:
+            version = returned[0]
+        cursor.close()
+        return version
+
     @property
     def last_updated( self ):
         '''Returns time when database was last updated'''
@@ -112,20 +297,20 @@ class SQLdb():
         returned    = None
         cursor      = self.database.cursor()
         try:
-            search_name = '%' + re.sub( r"\s", '%', name ) + '%'
+            ( condition, params ) = self._name_match( table, name )
             if region != None:
                 returned = cursor.execute(
                     'SELECT id ' + \
                     'FROM %s ' % table + \
-                    'WHERE search_name LIKE ? and region=? ORDER BY id',
-                    ( search_name, region ) 
+                    'WHERE %s and region=? ORDER BY id' % condition,
+                    params + [ region ]
                 ).fetchall()
             else:
                 returned = cursor.execute(
                     'SELECT id ' + \
                     'FROM %s ' % table + \
-                    'WHERE search_name LIKE ? ORDER BY id',
-                    ( search_name, ) 
+                    'WHERE %s ORDER BY id' % condition,
+                    params
                 ).fetchall()
             if returned:
                 result = [ x[0] for x in returned ]
@@ -152,15 +337,26 @@ class SQLdb():
         return result
 
     def remove_local( self, path ):
-        '''Remove rom from local table by given path'''
+        '''Remove rom from local table by given path, archive path also
+        removes all of its members'''
         cursor = self.database.cursor()
         try:
-            cursor.execute( 'DELETE from local where path LIKE ?', (
-                '%s%%' % path, ) )
+            cursor.execute( 'DELETE from local where path = ? OR ' + \
+                    '( path > ? AND path < ? )', (
+                path, '%s:' % path, '%s;' % path ) )
         except sqlite3.OperationalError:
             self._create_tables()
         cursor.close()
 
+    def remove_local_many( self, path_list ):
+        '''Remove roms from local table by given exact paths'''
+        cursor = self.database.cursor()
+        cursor.executemany(
+            'DELETE FROM local WHERE path=?',
+            [ ( path, ) for path in path_list ]
+        )
+        cursor.close()
+
     def file_info( self, lid ):
         '''Returns file information from local table by given local id'''
         cursor = self.database.cursor()
@@ -212,6 +408,167 @@ class SQLdb():
             self._create_tables()
         cursor.close()
 
+    def add_local_many( self, local_list ):
+        '''Adds list of roms to local table in one statement'''
+        query  = 'INSERT OR REPLACE INTO local ' + \
+                '( release_id, path, search_name, size, crc ) ' + \
+                'values ( ?, ?, ?, ?, ? )'
+        cursor = self.database.cursor()
+        try:
+            cursor.executemany( query, local_list )
+        except sqlite3.OperationalError:
+            self._create_tables()
+            cursor.executemany( query, local_list )
+        cursor.close()
+
+    def cached_crc( self, fingerprint ):
+        '''Returns ( size, crc ) of file if its fingerprint did not change'''
+        result = None
+        if fingerprint:
+            cursor = self.database.cursor()
+            result = cursor.execute(
+                'SELECT nds_size, crc FROM fingerprints ' + \
+                'WHERE path=? AND member=? AND size=? AND mtime_ns=? ' + \
+                'AND inode=? AND device=?',
+                fingerprint
+            ).fetchone()
+            cursor.close()
+        return result
+
+    def add_fingerprints( self, fingerprint_list ):
+        '''Stores ( path, member, size, mtime_ns, inode, device, nds_size,
+        crc ) rows in fingerprint cache'''
+        cursor = self.database.cursor()
+        cursor.executemany(
+            'INSERT OR REPLACE INTO fingerprints VALUES(?,?,?,?,?,?,?,?)',
+            fingerprint_list
+        )
+        cursor.close()
+
+    def add_pending( self, pending_list ):
+        '''Adds ( path, search_name, size, crc ) rows of roms waiting for
+        identification'''
+        cursor = self.database.cursor()
+        cursor.executemany(
+            'INSERT OR REPLACE INTO pending VALUES(?,?,?,?)',
+            pending_list
+        )
+        cursor.close()
+
+    def remove_pending( self, path_list ):
+        '''Removes roms from pending table by given paths'''
+        cursor = self.database.cursor()
+        cursor.executemany(
+            'DELETE FROM pending WHERE path=?',
+            [ ( path, ) for path in path_list ]
+        )
+        cursor.close()
+
+    def pending_list( self ):
+        '''Returns ( path, size, crc ) of roms waiting for identification'''
+        cursor = self.database.cursor()
+        result = cursor.execute(
+            'SELECT path, size, crc FROM pending ORDER BY path' ).fetchall()
+        cursor.close()
+        return result
+
+    def archive_listing( self, path, size, mtime_ns ):
+        '''Returns stored ( member, size, crc ) list of archive in archive
+        order, None if it was never listed or changed since'''
+        result = None
+        cursor = self.database.cursor()
+        if cursor.execute(
+            'SELECT path FROM archives WHERE path=? AND size=? AND mtime_ns=?',
+            ( path, size, mtime_ns )
+        ).fetchone():
+            result = cursor.execute(
+                'SELECT member, size, crc FROM archive_members ' + \
+                'WHERE path=? ORDER BY rowid',
+                ( path, )
+            ).fetchall()
+        cursor.close()
+        return result
+
+    def store_archive_listing( self, path, size, mtime_ns, member_list ):
+        '''Stores ( member, size, crc ) list of archive'''
+        cursor = self.database.cursor()
+        cursor.execute( 'DELETE FROM archive_members WHERE path=?', ( path, ) )
+        cursor.execute(
+            'INSERT OR REPLACE INTO archives VALUES(?,?,?)',
+            ( path, size, mtime_ns )
+        )
+        cursor.executemany(
+            'INSERT INTO archive_members VALUES(?,?,?,?)',
+            [ ( path, ) + member for member in member_list ]
+        )
+        cursor.close()
+
+    def listed_crc( self, path, member ):
+        '''Returns ( size, crc ) of archive member from stored listing'''
+        cursor = self.database.cursor()
+        result = cursor.execute(
+            'SELECT size, crc FROM archive_members WHERE path=? AND member=?',
+            ( path, member )
+        ).fetchone()
+        cursor.close()
+        return result
+
+    def known_list( self ):
+        '''Yields ( id, name, crc, publisher, released_by, region,
+        search_name ) rows of known table'''
+        cursor = self.database.cursor()
+        for row in cursor.execute(
+            'SELECT id, name, crc, publisher, released_by, region, ' + \
+            'search_name FROM known ORDER BY id'
+        ):
+            yield row
+        cursor.close()
+
+    def local_roms( self, name ):
+        '''Returns local roms matching name together with their known rom
+        information, in one query. Rows are file_info() columns followed by
+        rom_info() columns'''
+        return list( self.iter_local_roms( [ name ] ) )
+
+    def iter_local_roms( self, names = None, limit = None, offset = 0,
+            sort = 'id' ):
+        '''Yields local_roms rows matching any of names (all roms if none are
+        given) straight from the cursor, sorted by one of SORT_COLUMNS'''
+        conditions = []
+        params     = []
+        for name in names or []:
+            ( condition, name_params ) = self._name_match( 'local', name )
+            conditions.append( '( %s )' % condition )
+            params += name_params
+        query = 'SELECT %s FROM local ' % LOCAL_ROM_COLUMNS + \
+                'LEFT JOIN known ON known.id = local.release_id'
+        if conditions:
+            query += ' WHERE %s' % ' OR '.join( conditions )
+        query += ' ORDER BY %s, local.id' % SORT_COLUMNS[sort]
+        if limit is not None or offset:
+            query += ' LIMIT ? OFFSET ?'
+            params += [ -1 if limit is None else limit, offset ]
+
+        cursor = self.database.cursor()
+        try:
+            for row in cursor.execute( query, params ):
+                yield row
+        finally:
+            cursor.close()
+
+    def dupe_roms( self ):
+        '''Returns local roms sharing crc with other local roms, in the same
+        format as local_roms, ordered by crc'''
+        cursor = self.database.cursor()
+        result = cursor.execute(
+            'SELECT %s FROM local ' % LOCAL_ROM_COLUMNS + \
+            'LEFT JOIN known ON known.id = local.release_id ' + \
+            'WHERE local.crc IN ( SELECT crc FROM local GROUP BY crc ' + \
+            'HAVING COUNT(*) > 1 ) ORDER BY local.crc, local.id'
+        ).fetchall()
+        cursor.close()
+        return result
+
     def find_dupes( self ):
         '''Searches for duplicate roms'''
         result = []
@@ -268,21 +625,78 @@ class SQLdb():
         '''Commits changes to database'''
         self.database.commit()
 
+class KnownIndex():
+    '''In-memory copy of known table, answers search_crc, search_name and
+    rom_info like SQLdb does without querying the database'''
+    def __init__( self, database ):
+        self.crcs     = {}
+        self.roms     = {}
+        self.trigrams = {}
+        for ( relid, name, crc, publisher, released_by, region,
+                search_name ) in database.known_list():
+            self.crcs.setdefault( crc, [] ).append( relid )
+            self.roms[relid] = ( relid, name, publisher, released_by, region,
+                    search_name )
+            for trigram in name_trigrams( search_name or '' ):
+                self.trigrams.setdefault( trigram, set() ).add( relid )
+
+    def search_crc( self, crc, table = 'known' ):
+        '''Search roms by crc, returns list'''
+        return list( self.crcs.get( crc, [] ) )
+
+    def search_name( self, name, region = None, table = 'known' ):
+        '''Search roms by name [and regioncode], returns list. Matches the
+        same names as LIKE query of SQLdb.search_name'''
+        pattern = '%' + re.sub( r"\s", '%', name ) + '%'
+        matcher = re.compile( ''.join( [ { '%' : '.*', '_' : '.' }.get( char,
+            re.escape( char ) ) for char in pattern ] ) + '$',
+            re.IGNORECASE | re.DOTALL )
+
+        candidates = None
+        for literal in re.split( '[%_]', pattern.lower() ):
+            for trigram in name_trigrams( literal ):
+                found = self.trigrams.get( trigram, set() )
+                if candidates is None:
+                    candidates = found
+                else:
+                    candidates = candidates & found
+        if candidates is None:
+            candidates = self.roms.keys()
+
+        result = []
+        for relid in candidates:
+            rom = self.roms[relid]
+            if ( region is None or rom[4] == region ) and \
+                    matcher.match( rom[5] or '' ):
+                result.append( relid )
+        return sorted( result )
+
+    def rom_info( self, relid ):
+        '''Returns rom information by given release id'''
+        return self.roms.get( relid, ( None, None, None, None, None, None ) )
+
+def name_trigrams( name ):
+    '''Returns set of lowercase three-character substrings of name'''
+    name = name.lower()
+    return set( name[i:i + 3] for i in range( len( name ) - 2 ) )
+
 class AdvansceneXML():
     '''Advanscene xml parser'''
     def __init__( self, path = None ):
-        self.path     = path
-        self.rom_list = []
+        self.path         = path
+        self.rom_list     = []
+        self._dat_version = None
 
-    def update( self, database, tmp_dir ):
+    def update( self, database, tmp_dir, force = False ):
         '''Download new xml from advanscene'''
+        import urllib2
         updated    = False
         dat_url    = 'http://advanscene.com/offline/datas/ADVANsCEne_NDS_S.zip'
         zip_path   = '%s/%s' % ( tmp_dir, dat_url.split('/')[-1] )
 
         try:
             url_handler = urllib2.urlopen( dat_url )
-            if time.gmtime( database.last_updated ) < time.strptime(
+            if force or time.gmtime( database.last_updated ) < time.strptime(
                     url_handler.info().getheader( 'Last-Modified' ),
                     '%a, %d %b %Y %H:%M:%S %Z' ):
                 updated = True
@@ -296,8 +710,14 @@ class AdvansceneXML():
 
                 tmp_db = '%s/%s' % ( tmp_dir, archive_xml )
                 self.path = tmp_db
-                self.parse()
-                database.import_known( self )
+                previous_version = database.dat_version
+                counts = database.import_known( self, force )
+                log = logging.getLogger( 'pyromgr' )
+                log.info( 'Known roms: %d added, %d changed, %d unchanged' %
+                        counts )
+                if counts[:2] == ( 0, 0 ) and \
+                        self.dat_version == previous_version:
+                    updated = False
 
                 os.unlink( tmp_db )
                 os.unlink( zip_path )
@@ -308,12 +728,44 @@ class AdvansceneXML():
 
         return updated
 
+    @property
+    def dat_version( self ):
+        '''Dat version from configuration section of the xml file'''
+        if self._dat_version is None and self.path:
+            from xml.etree import cElementTree as ElementTree
+            try:
+                file_handler = open( self.path, 'rb' )
+                for ( event, node ) in ElementTree.iterparse( file_handler ):
+                    if node.tag == 'datVersion':
+                        self._dat_version = node.text
+                    if node.tag in ( 'datVersion', 'game' ):
+                        break
+                file_handler.close()
+            except IOError:
+                raise Exception( 'AdvParse',
+                        'Can not open or parse file %s' % self.path )
+        return self._dat_version
+
     def parse( self ):
         '''Parses the xml file'''
+        self.rom_list = list( self.iter_games() )
+
+    def iter_games( self ):
+        '''Streams roms from the xml file, already processed game elements are
+        dropped so memory use does not depend on the size of the file'''
+        from xml.etree import cElementTree as ElementTree
         try:
-            xml = minidom.parse( self.path )
-            for node in xml.getElementsByTagName( 'game' ):
-                self.rom_list.append( parse_node( node ) )
+            parents = []
+            for ( event, node ) in ElementTree.iterparse( self.path,
+                    events = ( 'start', 'end' ) ):
+                if event == 'start':
+                    parents.append( node )
+                    continue
+
+                parents.pop()
+                if node.tag == 'game':
+                    yield parse_node( node )
+                    parents[-1].clear()
         except IOError:
             raise Exception( 'AdvParse',
                     'Can not open or parse file %s' % self.path )
@@ -322,7 +774,9 @@ class AdvansceneXML():
         return self.rom_list.__contains__( item )
 
     def __iter__( self ):
-        return self.rom_list.__iter__()
+        if self.rom_list:
+            return self.rom_list.__iter__()
+        return self.iter_games()
 
     def __len__( self ):
         return self.rom_list.__len__()
@@ -332,33 +786,25 @@ class AdvansceneXML():
 
 def parse_node( node ):
     '''Parse node'''
-    title = node_text( node.getElementsByTagName( 'title' )[0].childNodes )
-    publisher = node_text(
-            node.getElementsByTagName( 'publisher' )[0].childNodes )
-    released_by = node_text(
-            node.getElementsByTagName( 'sourceRom' )[0].childNodes )
-    region = int( node_text(
-            node.getElementsByTagName( 'location' )[0].childNodes ) )
-    release_number = int( node_text(
-            node.getElementsByTagName( 'releaseNumber' )[0].childNodes ) )
+    title          = node_text( node, 'title' )
+    publisher      = node_text( node, 'publisher' )
+    released_by    = node_text( node, 'sourceRom' )
+    region         = int( node_text( node, 'location' ) )
+    release_number = int( node_text( node, 'releaseNumber' ) )
     crc = node_crc( node )
     normalized_name = strip_name( title.lower() )
     return ( release_number, title, crc, publisher, released_by,
             region, normalized_name )
 
-def node_text( node_list ):
-    '''Extract text from node'''
-    text = []
-    for node in node_list:
-        if node.nodeType == node.TEXT_NODE:
-            text.append( node.data )
-    return ''.join( text )
+def node_text( node, tag ):
+    '''Extract text of child node'''
+    return unicode( node.findtext( tag ) or '' )
 
 def node_crc( node ):
     '''Returns crc from rom node'''
-    for crc in node.getElementsByTagName( 'romCRC' ):
-        if crc.getAttribute( 'extension' ) != '.nds':
+    for crc in node.iter( 'romCRC' ):
+        if crc.get( 'extension' ) != '.nds':
             continue
         else:
-            return int( node_text( crc.childNodes ), 16 )
+            return int( crc.text, 16 )
     return None
@@ -1,33 +1,117 @@
 '''Provides classes related to roms'''
-import os, re, zipfile, subprocess, shutil
-import struct, binascii, time
+import os, re, shutil, sys
+import struct, binascii, time, itertools, errno, hashlib
 import logging
 from cfg import region_name, region_code
 import threading, Queue
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+HEADER_SIZE = 512
+CHUNK_SIZE  = 1048576
+# Flashcarts are slow removable media, so uploads are written in big chunks
+UPLOAD_CHUNK_SIZE = 8 * CHUNK_SIZE
+
+BATCH_SIZE   = 500
+BATCH_WINDOW = 2
+
+# Records roms uploaded by sync_roms, kept in the flashcart root
+MANIFEST_NAME = '.pyromgr-manifest.json'
+
+# ( pattern, replacement ) pairs applied by strip_name
+STRIP_PATTERNS = [
+    ( re.compile( r"(\(|\[)[^\(\)\[\]]*(\)|\])" ) , ''  ),
+    ( re.compile( r"(^|\s)(the|and|a|\&)(\s|$)" ) , ' ' ),
+    ( re.compile( r"[^\w\d\s]" )                  , ''  ),
+    ( re.compile( r"\s+" )                        , ' ' ),
+]
+# ( pattern, replacement ) pairs applied to lowercased filename by parse_filename
+FILENAME_PATTERNS = [
+    ( re.compile( r"^.*(/|:)" ) , ''  ),
+    ( re.compile( r"\.[^.]+$" ) , ''  ),
+    ( re.compile( r"_" )        , ' ' ),
+]
+RELEASE_NUMBER_RE = re.compile( r"((\[|\()?(\d+)(\]|\))|(\d+)\s*-\s*)\s*(.*)" )
+TAG_RE            = re.compile( r"(\(|\[)(\w+)(\)|\])" )
+EXTENSION_RE      = re.compile( r".*\.([^.]+)$" )
+
+# Release number, name and region parsed from file name
+NameInfo = namedtuple( 'NameInfo', 'release_id normalized_name region' )
+# Stored local table information
+DbInfo   = namedtuple( 'DbInfo', 'relid size crc' )
 
 class AddWorker( threading.Thread ):
-    '''Worker for adding roms to db'''
-    def __init__( self, queue ):
+    '''Worker for adding roms to db. Rows are committed in batches of
+    batch_size or every batch_window seconds, None in queue flushes the last
+    batch and stops the worker. Roms that can't be identified without asking
+    the user are put to pending table'''
+    def __init__( self, queue, database, batch_size = BATCH_SIZE,
+            batch_window = BATCH_WINDOW ):
         threading.Thread.__init__( self )
-        self.queue = queue
+        self.queue        = queue
+        self.database     = database
+        self.batch_size   = batch_size
+        self.batch_window = batch_window
+        self.batch        = []
+        self.pending      = []
+        self.fingerprints = []
+        self.started      = None
+
+    def flush( self ):
+        '''Write and commit current batch'''
+        if self.batch or self.pending:
+            self.database.add_local_many( self.batch )
+            self.database.remove_pending( [ row[1] for row in self.batch ] )
+            self.database.add_pending( self.pending )
+            self.database.add_fingerprints( self.fingerprints )
+            self.database.save()
+            self.batch        = []
+            self.pending      = []
+            self.fingerprints = []
+        self.started = None
 
     def run( self ):
         '''Run thread'''
         while True:
-            rom = self.queue.get()
-            rom.add_to_db()
+            try:
+                rom = self.queue.get( True, self.batch_window )
+            except Queue.Empty:
+                self.flush()
+                continue
+
+            if rom is None:
+                self.flush()
+                self.queue.task_done()
+                break
+
+            if not self.started:
+                self.started = time.time()
+            local_info = rom.local_info( interactive = False )
+            if local_info:
+                self.batch.append( local_info )
+            else:
+                self.pending.append( rom.pending_info() )
+            if rom.file_info.fingerprint:
+                self.fingerprints.append( rom.file_info.fingerprint + (
+                    rom.file_info.size, rom.file_info.crc ) )
+            if len( self.batch ) + len( self.pending ) >= self.batch_size or \
+                    time.time() - self.started >= self.batch_window:
+                self.flush()
             self.queue.task_done()
 
-class RomInfo:
+class RomInfo( object ):
     '''Rom information from database'''
-    def __init__( self, db_info ):
-        self.relid           = None
-        self.name            = None
-        self.publisher       = None
-        self.released_by     = None
-        self.region          = None
-        self.normalized_name = None
+    __slots__ = ( 'relid', 'name', 'publisher', 'released_by', 'region',
+            'normalized_name' )
 
+    def __init__( self, db_info ):
         ( self.relid, self.name, self.publisher, self.released_by, self.region,
                 self.normalized_name ) = db_info
 
@@ -42,49 +126,60 @@ class RomInfo:
         return "%4s - %s (%s) [%s]" % ( self.relid, self.name,
                 region_name( self.region ), self.released_by )
 
-class FileInfo:
+class FileInfo( object ):
     '''Local file information'''
-    def __init__( self, path, tmp_dir, db_info = None ):
+    __slots__ = ( 'tmp_dir', 'verify', 'nds', 'name_info', 'db_info', 'path',
+            'fingerprint' )
+
+    def __init__( self, path, tmp_dir, db_info = None, verify = False ):
         self.tmp_dir   = tmp_dir
+        self.verify    = verify
         self.nds       = None
         self.name_info = None
         self.db_info   = None
         self.path      = None
 
+        self.fingerprint = None
+
         if path:
             self.path = path
         elif db_info != None:
             ( release_id, path, size, crc ) = db_info
             self.path = path
-            self.db_info = {
-                    'relid' : release_id,
-                    'size'  : size,
-                    'crc'   : crc,
-            }
+            self.db_info = DbInfo( release_id, size, crc )
             self._parse_name()
 
-    def init( self ):
-        '''Get nds object and prepare name_info'''
+    def init( self, cached = None, nds = None ):
+        '''Get nds object and prepare name_info, already parsed nds is used
+        when given'''
+        if not nds:
+            nds = self._read_nds( cached )
+
+        self.nds = nds
+        self._parse_name()
+
+    def _read_nds( self, cached = None ):
+        '''Get nds object, cached ( size, crc ) is used instead of reading
+        the file when given'''
         nds = None
-        if self.is_archived():
+        if cached:
+            nds = Nds( self.path )
+            ( nds.size, nds.crc ) = cached
+        elif self.is_archived():
+            self.fingerprint = fingerprint( self.path )
             ( archive_path, nds_name ) = self._split_path()
             archive = archive_obj( archive_path, self.tmp_dir )
-            nds = archive.get_nds( nds_name )
+            nds = archive.get_nds( nds_name, self.verify )
         else:
+            self.fingerprint = fingerprint( self.path )
             nds = Nds( self.path )
             nds.parse()
-
-        self.nds = nds
-        self._parse_name()
+        return nds
 
     def _parse_name( self ):
         '''Parse filename'''
         ( relid, name, region ) = parse_filename( self.path )
-        self.name_info = {
-            'release_id'      : relid,
-            'normalized_name' : name,
-            'region'          : region,
-        }
+        self.name_info = NameInfo( relid, name, region )
 
     def _split_path( self ):
         '''Split archive path'''
@@ -117,7 +212,7 @@ class FileInfo:
         '''Normalized filename'''
         if not self.is_initialized():
             self.init()
-        return self.name_info['normalized_name']
+        return self.name_info.normalized_name
 
     @property
     def size( self ):
@@ -128,7 +223,7 @@ class FileInfo:
         if self.nds:
             result = self.nds.size
         elif self.db_info:
-            result = self.db_info['size']
+            result = self.db_info.size
         return result
 
     @property
@@ -140,7 +235,7 @@ class FileInfo:
         if self.nds:
             result = "%.2fM" % ( self.nds.size / 1048576.0 )
         elif self.db_info:
-            result = "%.2fM" % ( self.db_info['size'] / 1048576.0 )
+            result = "%.2fM" % ( self.db_info.size / 1048576.0 )
         return result
 
     @property
@@ -152,26 +247,58 @@ class FileInfo:
         if self.nds:
             result = self.nds.crc
         elif self.db_info:
-            result = self.db_info['crc']
+            result = self.db_info.crc
         return result
 
-    def upload( self, path, filename = None ):
-        '''Copy rom to flashcart'''
+    def upload( self, path, filename = None, progress = None ):
+        '''Copy rom to flashcart, returns True on success. The rom is streamed
+        to a temporary file which is renamed only after its crc is verified.
+        progress is called with ( bytes written, expected size )'''
+        log = logging.getLogger( 'pyromgr' )
         if not filename:
             filename = re.sub( r"^.*(/|:)", '', self.path )
+        ( expected_crc, expected_size ) = ( None, None )
+        if self.is_initialized():
+            ( expected_crc, expected_size ) = ( self.crc, self.size )
+        if progress:
+            report = lambda size: progress( size, expected_size )
+        else:
+            report = None
 
+        target_path = '%s/%s' % ( path, filename )
+        tmp_path    = '%s/.%s.part' % ( path, filename )
+        started     = time.time()
+        uploaded    = False
         try:
-            if self.is_archived():
-                ( archive_path, nds_name ) = self._split_path()
-                archive = archive_obj( archive_path, self.tmp_dir )
-                archive.extract( nds_name, path )
-                os.rename( '%s/%s' % ( path, nds_name ),
-                        '%s/%s' % ( path, filename ) )
-            else:
-                shutil.copy( self.path, '%s/%s' % ( path, filename ) )
+            with open( tmp_path, 'wb', 0 ) as file_handler:
+                if self.is_archived():
+                    ( archive_path, nds_name ) = self._split_path()
+                    archive = archive_obj( archive_path, self.tmp_dir )
+                    ( crc, size ) = archive.copy_member( nds_name,
+                            file_handler, report )
+                else:
+                    with open( self.path, 'rb' ) as source:
+                        ( crc, size ) = stream_crc( source,
+                                chunk_size = UPLOAD_CHUNK_SIZE,
+                                output = file_handler, progress = report )
+                os.fsync( file_handler.fileno() )
+            if expected_crc is not None and crc != expected_crc:
+                raise IOError( 'crc mismatch for %s: %08x instead of %08x' % (
+                    self.path, crc, expected_crc ) )
+            os.rename( tmp_path, target_path )
+            uploaded = True
         except( IOError, OSError ) as exc:
-            log = logging.getLogger( 'pyromgr' )
             log.error( 'Upload failed: %s' % exc )
+        finally:
+            if not uploaded and os.path.exists( tmp_path ):
+                os.unlink( tmp_path )
+        if not uploaded:
+            return False
+
+        elapsed = max( time.time() - started, 0.001 )
+        log.info( 'Uploaded %s: %.2fM in %.1fs (%.2fM/s)' % ( filename,
+            size / 1048576.0, elapsed, size / 1048576.0 / elapsed ) )
+        return True
 
     def remove( self ):
         '''Delete file and remove from local table'''
@@ -179,23 +306,31 @@ class FileInfo:
         os.unlink( path )
 
     def __str__( self ):
-        return '%s (%s)' % ( self.name_info['normalized_name'], self.path )
+        return '%s (%s)' % ( self.name_info.normalized_name, self.path )
 
-class Rom:
+class Rom( object ):
     '''internal representation of roms'''
+    __slots__ = ( 'database', 'config', 'ui_handler', 'rom_info', 'file_info',
+            'index' )
 
     def __init__( self, path, database, config, ui_handler = None,
-            rom_info = None, file_info = None ):
+            rom_info = None, file_info = None, index = None ):
         self.database   = database
         self.config     = config
         self.ui_handler = ui_handler
         self.rom_info   = rom_info
         self.file_info  = file_info
+        self.index      = index
 
         if not self.file_info:
             self.file_info = FileInfo( os.path.abspath( path ),
                     config.tmp_dir )
 
+    @property
+    def known( self ):
+        '''Source of known rom information, in-memory index if given'''
+        return self.index or self.database
+
     def is_valid( self ):
         '''If rom is valid'''
         return self.file_info.is_valid()
@@ -209,21 +344,32 @@ class Rom:
         if self.file_info.is_initialized() or self.rom_info:
             return True
 
-    def add_to_db( self ):
-        '''Add current rom file to database'''
+    def local_info( self, interactive = True ):
+        '''Row for local table, identifies rom if needed. None if rom could
+        not be identified without asking and interactive is False'''
         if not self.rom_info:
-            self.rom_info  = self.get_rom_info()
+            self.rom_info  = self.get_rom_info( interactive )
+            if not self.rom_info:
+                return None
 
-        local_info = ( self.rom_info.relid, self.file_info.path,
+        return ( self.rom_info.relid, self.file_info.path,
                 self.normalized_name, self.file_info.size, self.file_info.crc )
-        self.database.add_local( local_info )
+
+    def pending_info( self ):
+        '''Row for pending table'''
+        return ( self.file_info.path, self.file_info.normalized_name,
+                self.file_info.size, self.file_info.crc )
+
+    def add_to_db( self ):
+        '''Add current rom file to database'''
+        self.database.add_local( self.local_info() )
         self.database.save()
 
     def _confirm_file( self, relid = None ):
         '''Confirm that file was detected right'''
         result = None
         if type( relid ) == int:
-            rom_obj = RomInfo( self.database.rom_info( relid ) )
+            rom_obj = RomInfo( self.known.rom_info( relid ) )
             premsg = "*%s*\nIdentified as %s" % (
                     os.path.basename( self.file_info.path ),
                     rom_obj
@@ -232,7 +378,7 @@ class Rom:
         elif type( relid ) == list:
             pre_msg = "*%s*\nCan be one of the following:" % (
                     os.path.basename( self.file_info.path ) )
-            rom_list = [ RomInfo( self.database.rom_info( release_id ) ) for
+            rom_list = [ RomInfo( self.known.rom_info( release_id ) ) for
                 release_id in relid ]
             result = self.ui_handler.list_question( pre_msg, rom_list,
                     "Which one?" )
@@ -262,45 +408,46 @@ class Rom:
             else:
                 search_name = self._ask_name()
                 if search_name:
-                    new_relid_list = self.database.search_name(
+                    new_relid_list = self.known.search_name(
                             search_name, table = 'known' )
                     if new_relid_list:
                         relid = self._name_search( new_relid_list )
         return relid
 
-    def get_rom_info( self ):
-        '''Get rom info from database'''
+    def get_rom_info( self, interactive = True ):
+        '''Get rom info from database. Returns None when user has to be asked
+        and interactive is False'''
         relid = None
 
         if self.file_info.db_info:
-            relid = self.file_info.db_info['relid']
+            relid = self.file_info.db_info.relid
         else:
             try:
-                relid = self.database.search_crc( self.file_info.crc,
+                relid = self.known.search_crc( self.file_info.crc,
                         'known' )[0]
             except( TypeError, IndexError ):
                 pass
             if not relid:
-                relid_list = self.database.search_name(
+                relid_list = self.known.search_name(
                         self.file_info.normalized_name,
-                        self.file_info.name_info['region'], table = 'known' )
-                if ( self.file_info.name_info['release_id'] in relid_list ) or \
-                        (
-                            self.file_info.name_info['release_id'] and \
-                            self._confirm_file(
-                            self.file_info.name_info['release_id'] )
-                        ):
-                    relid = self.file_info.name_info['release_id']
+                        self.file_info.name_info.region, table = 'known' )
+                release_id = self.file_info.name_info.release_id
+                if release_id in relid_list:
+                    relid = release_id
+                elif not interactive:
+                    return None
+                elif release_id and self._confirm_file( release_id ):
+                    relid = release_id
                 elif relid_list:
                     relid = self._name_search( relid_list )
                 else:
                     search_name = self._ask_name()
                     if search_name:
-                        relid_list = self.database.search_name(
+                        relid_list = self.known.search_name(
                                 search_name, table = 'known' )
                         if relid_list:
                             relid = self._name_search( relid_list )
-        return RomInfo( self.database.rom_info( relid ) )
+        return RomInfo( self.known.rom_info( relid ) )
 
     @property
     def path( self ):
@@ -322,9 +469,17 @@ class Rom:
         self.database.remove_local( re.sub( r":.*$", '', self.file_info.path ) )
         self.file_info.remove()
 
-    def upload( self, path ):
-        '''Copy rom to flashcart'''
-        self.file_info.upload( path, self.rom_info.filename )
+    def upload( self, path, progress = None ):
+        '''Copy rom to flashcart, returns True on success'''
+        return self.file_info.upload( path, self.rom_info.filename, progress )
+
+    def manifest_entry( self ):
+        '''Flashcart manifest record of this rom'''
+        return {
+            'relid' : self.rom_info.relid,
+            'size'  : self.file_info.size,
+            'crc'   : self.file_info.crc,
+        }
 
     def get_saves( self ):
         '''Check if rom has any backed up saves'''
@@ -360,8 +515,15 @@ class Rom:
 
         return ' '.join( string )
 
-class SaveFile:
+def rom_from_row( row, database, config, ui_handler = None ):
+    '''Create Rom from SQLdb.local_roms row'''
+    return Rom( None, database, config, ui_handler,
+            rom_info = RomInfo( row[4:] ),
+            file_info = FileInfo( None, config.tmp_dir, row[:4] ) )
+
+class SaveFile( object ):
     '''Rom savefile'''
+    __slots__ = ( 'relid', 'lid', 'mtime', 'local_name', 'remote_name' )
     def __init__( self, relid, lid, mtime, filename, config ):
         self.relid       = int( relid )
         self.lid         = int( lid )
@@ -388,56 +550,72 @@ class SaveFile:
     def __str__( self ):
         return time.strftime( "%x %X", time.localtime( self.mtime ) )
 
-class Nds:
-    ''' Reads the contents of .nds files '''
+class Nds( object ):
+    ''' Reads the contents of .nds files. Crc is None when contents could
+    not be read '''
+    __slots__ = ( 'file_path', 'title', 'code', 'maker', 'unit_code',
+            'encryption', 'capacity', 'crc', 'size' )
+
     def __init__( self, file_path ):
         self.file_path = os.path.abspath( file_path )
-        self.rom       = {}
-        self.hardware  = {}
+        for field in self.__slots__[1:]:
+            setattr( self, field, None )
 
     def is_valid( self ):
         '''Checks validity of rom'''
         valid = 1
-        if self.hardware['capacity'] > 4096:
+        if self.crc is None or ( self.capacity or 0 ) > 4096:
             valid = 0
         return valid
 
+    @property
+    def rom( self ):
+        '''Known rom information as dict'''
+        return dict( ( key, value ) for ( key, value ) in (
+            ( 'title', self.title ), ( 'code', self.code ),
+            ( 'maker', self.maker ), ( 'crc32', self.crc ),
+            ( 'size', self.size ) ) if value is not None )
+
+    @property
+    def hardware( self ):
+        '''Known hardware information as dict'''
+        return dict( ( key, value ) for ( key, value ) in (
+            ( 'unit_code', self.unit_code ),
+            ( 'encryption', self.encryption ),
+            ( 'capacity', self.capacity ) ) if value is not None )
+
     def parse( self ):
         '''Read data from file'''
         try:
             file_handler = open( self.file_path, 'rb' )
-
-            file_handler.seek( 0 )
-            self.rom['title'] = byte_to_string( file_handler.read( 12 ) )
-            self.rom['code']  = byte_to_string( file_handler.read( 4 ) )
-            self.rom['maker'] = byte_to_string( file_handler.read( 2 ) )
-
-            self.hardware['unit_code']  = byte_to_int( file_handler.read( 1 ) )
-            self.hardware['encryption'] = byte_to_int( file_handler.read( 1 ) )
-            self.hardware['capacity']   = pow( 2,
-                20 + byte_to_int( file_handler.read( 2 ) )
-            ) / 8388608
-
-            file_handler.seek( 0 )
-            self.rom['crc32'] = binascii.crc32( file_handler.read() ) & \
-                    0xFFFFFFFF
-            self.rom['size']  = os.path.getsize( self.file_path )
-
+            self.parse_stream( file_handler )
             file_handler.close()
         except IOError as exc:
             log = logging.getLogger( 'pyromgr' )
             log.warning( 'Failed to read file %s: %s' % ( self.file_path, exc )
                     )
 
-    @property
-    def crc( self ):
-        '''CRC checksum of file'''
-        return self.rom['crc32']
+    def parse_header( self, header ):
+        '''Read rom and hardware information from header bytes'''
+        self.title = byte_to_string( header[0:12] )
+        self.code  = byte_to_string( header[12:16] )
+        self.maker = byte_to_string( header[16:18] )
 
-    @property
-    def size( self ):
-        '''Size of file'''
-        return self.rom['size']
+        self.unit_code  = byte_to_int( header[18:19] )
+        self.encryption = byte_to_int( header[19:20] )
+        self.capacity   = pow( 2,
+            20 + byte_to_int( header[20:22] )
+        ) / 8388608
+
+    def parse_stream( self, file_handler ):
+        '''Read header and checksum from file-like object, chunk by chunk'''
+        header = file_handler.read( HEADER_SIZE )
+        self.parse_header( header )
+
+        ( crc, size ) = stream_crc( file_handler,
+                binascii.crc32( header ), len( header ) )
+        self.crc  = crc
+        self.size = size
 
 class Archive:
     '''Generic archive handler'''
@@ -445,15 +623,37 @@ class Archive:
         self.path      = os.path.abspath( path )
         self.tmp_dir   = os.path.abspath( tmp_dir )
         self.file_list = []
+        self.sizes     = {}
+        self.crcs      = {}
 
     def is_valid( self ):
         '''Check if archive contains any nds files'''
         if len( self.file_list ):
             return True
 
-    def extract( self, archive_file, path ):
-        '''Extract specified file to path'''
-        return "%s/%s" % ( path, archive_file )
+    def scan_files_cached( self, database ):
+        '''Scan archive for nds files, listing stored in database is used if
+        the archive did not change since it was made'''
+        file_stat = fingerprint( self.path )
+        listing   = None
+        if file_stat:
+            listing = database.archive_listing( self.path, file_stat[2],
+                    file_stat[3] )
+        if listing is None:
+            self.scan_files()
+            if file_stat:
+                database.store_archive_listing( self.path, file_stat[2],
+                        file_stat[3], [ ( name, self.sizes.get( name ),
+                            self.crcs.get( name ) ) for name in
+                            self.file_list ] )
+                database.save()
+        else:
+            for ( name, size, crc ) in listing:
+                self.file_list.append( name )
+                if size is not None:
+                    self.sizes[name] = size
+                if crc is not None:
+                    self.crcs[name] = crc
 
     def full_paths( self ):
         '''Returns list of full paths'''
@@ -462,80 +662,249 @@ class Archive:
             result.append( '%s:%s' % ( self.path, filename ) )
         return result
 
-    def get_nds( self, nds_name ):
-        '''Get parsed nds object from archive'''
-        self.extract( nds_name, self.tmp_dir )
-        tmp_file = '%s/%s' % ( self.tmp_dir, nds_name )
-        nds = Nds( tmp_file )
-        nds.parse()
-        os.unlink( tmp_file )
+    def stream_command( self, archive_files ):
+        '''Command printing specified files to stdout, one after another in
+        archive order'''
+        return None
+
+    def open_member( self, *archive_files ):
+        '''Start archiver streaming specified files, returns the process'''
+        import subprocess
+        devnull = open( os.devnull, 'w' )
+        process = subprocess.Popen( self.stream_command( list( archive_files ) ),
+                stdout = subprocess.PIPE, stderr = devnull,
+                bufsize = CHUNK_SIZE )
+        devnull.close()
+        return process
+
+    def get_nds( self, nds_name, verify = False ):
+        '''Get parsed nds object from archive, the file is read straight from
+        archiver's output without extracting it'''
+        nds = Nds( '%s:%s' % ( self.path, nds_name ) )
+        process = self.open_member( nds_name )
+        nds.parse_stream( process.stdout )
+        process.stdout.close()
+        if process.wait():
+            nds.crc = None
+            log = logging.getLogger( 'pyromgr' )
+            log.warning( 'Failed to read %s from %s: exit code %d' % (
+                nds_name, self.path, process.returncode ) )
         return nds
 
+    def copy_member( self, nds_name, file_handler, progress = None ):
+        '''Write file from archive to file_handler straight from archiver's
+        output, returns ( crc, size ) of written data'''
+        process = self.open_member( nds_name )
+        try:
+            result = stream_crc( process.stdout, chunk_size = UPLOAD_CHUNK_SIZE,
+                    output = file_handler, progress = progress )
+        except:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode:
+            raise IOError( 'Failed to read %s from %s: exit code %d' % (
+                nds_name, self.path, process.returncode ) )
+        return result
+
+    def iter_nds( self, nds_names, verify = False ):
+        '''Yields ( name, nds ) for specified files. With sizes known from
+        scan_files all of them are read in a single archiver run, so solid
+        archives are decompressed only once. All of them are invalid if the
+        archiver fails or its output does not end after the last one'''
+        wanted = set( nds_names )
+        names  = [ name for name in self.file_list if name in wanted ]
+        if len( names ) < 2 or len( names ) != len( wanted ) or \
+                [ name for name in names if name not in self.sizes ]:
+            for name in nds_names:
+                yield ( name, self.get_nds( name, verify ) )
+            return
+
+        log     = logging.getLogger( 'pyromgr' )
+        result  = []
+        process = self.open_member( *names )
+        try:
+            for name in names:
+                nds = Nds( '%s:%s' % ( self.path, name ) )
+                nds.parse_stream( LimitedReader( process.stdout,
+                    self.sizes[name] ) )
+                if nds.size != self.sizes[name]:
+                    nds.crc = None
+                    log.warning( 'Failed to read %s from %s' % ( name,
+                        self.path ) )
+                result.append( ( name, nds ) )
+            trailing = process.stdout.read( 1 )
+        finally:
+            process.stdout.close()
+            if process.poll() is None and len( result ) < len( names ):
+                process.kill()
+            process.wait()
+
+        if process.returncode or trailing:
+            log.warning( 'Failed to read %s: exit code %d%s' % ( self.path,
+                process.returncode, trailing and ', unexpected data' or '' ) )
+            for ( name, nds ) in result:
+                nds.crc = None
+        for item in result:
+            yield item
+
 class Zip( Archive ):
     '''Zip archive handler'''
     def scan_files( self, ext = 'nds' ):
         '''Scan archive'''
+        import zipfile
         archive = zipfile.ZipFile( self.path, 'r' )
-        for compressed in archive.namelist():
-            if re.search( "\.%s$" % ext, compressed, flags = re.IGNORECASE ):
-                self.file_list.append( compressed )
+        for info in archive.infolist():
+            if re.search( "\.%s$" % ext, info.filename,
+                    flags = re.IGNORECASE ):
+                self.file_list.append( info.filename )
+                self.sizes[info.filename] = info.file_size
+                self.crcs[info.filename]  = info.CRC
         archive.close()
 
     def extract( self, archive_file, path ):
         '''Extract specified file to path'''
+        import zipfile
         archive = zipfile.ZipFile( self.path, 'r' )
         archive.extract( archive_file, path )
         archive.close()
         return "%s/%s" % ( path, archive_file )
 
+    def copy_member( self, nds_name, file_handler, progress = None ):
+        '''Write file from archive to file_handler, returns ( crc, size ) of
+        written data'''
+        import zipfile
+        archive = zipfile.ZipFile( self.path, 'r' )
+        try:
+            member = archive.open( nds_name )
+            result = stream_crc( member, chunk_size = UPLOAD_CHUNK_SIZE,
+                    output = file_handler, progress = progress )
+            member.close()
+        except ( zipfile.BadZipfile, KeyError ) as exc:
+            raise IOError( 'Failed to read %s from %s: %s' % ( nds_name,
+                self.path, exc ) )
+        finally:
+            archive.close()
+        return result
+
+    def iter_nds( self, nds_names, verify = False ):
+        '''Yields ( name, nds ) for specified files'''
+        for name in nds_names:
+            yield ( name, self.get_nds( name, verify ) )
+
+    def get_nds( self, nds_name, verify = False ):
+        '''Get parsed nds object from archive. Crc and size are taken from
+        the central directory and only the header is decompressed, unless
+        verify is set, in which case the whole member is read and checked'''
+        import zipfile
+        nds = Nds( '%s:%s' % ( self.path, nds_name ) )
+        archive = zipfile.ZipFile( self.path, 'r' )
+        try:
+            info = archive.getinfo( nds_name )
+            member = archive.open( info )
+            if verify:
+                nds.parse_stream( member )
+            else:
+                nds.parse_header( member.read( HEADER_SIZE ) )
+                nds.crc  = info.CRC
+                nds.size = info.file_size
+            member.close()
+        except zipfile.BadZipfile as exc:
+            nds.crc = None
+            log = logging.getLogger( 'pyromgr' )
+            log.warning( 'Failed to read %s from %s: %s' % ( nds_name,
+                self.path, exc ) )
+        finally:
+            archive.close()
+        return nds
+
 class Zip7( Archive ):
     '''7zip archive handler'''
     def scan_files( self, ext = 'nds' ):
         '''Scan archive'''
-        list_archive = subprocess.Popen( [ '7z', 'l', self.path ],
+        import subprocess
+        list_archive = subprocess.Popen( [ '7z', 'l', '-slt', self.path ],
                 stdout = subprocess.PIPE, stderr = subprocess.PIPE )
 
-        list_started   = 0
-        filename_start = 0
+        list_started = False
+        filename     = None
         for line in list_archive.stdout.readlines():
-            line = line.rstrip()
-            if re.match( '-----', line ):
-                list_started ^= 1
-                filename_start = len( line.split( '  ' )[0] ) + 2
-            elif list_started:
-                filename = line[filename_start:]
-                if re.search( "\.%s$" % ext, filename, flags = re.IGNORECASE ):
+            line = line.rstrip( '\r\n' )
+            if line == '----------':
+                list_started = True
+                continue
+            match = re.match( r"(Path|Folder|Size|CRC) = (.*)$", line )
+            if not list_started or not match:
+                continue
+            ( key, value ) = match.groups()
+            if key == 'Path':
+                filename = None
+                if re.search( "\.%s$" % ext, value, flags = re.IGNORECASE ):
+                    filename = value
                     self.file_list.append( filename )
+            elif filename and key == 'Folder' and value == '+':
+                self.file_list.remove( filename )
+                filename = None
+            elif filename and key == 'Size' and value.isdigit():
+                self.sizes[filename] = int( value )
+            elif filename and key == 'CRC' and value:
+                self.crcs[filename] = int( value, 16 )
         list_archive.wait()
 
-    def extract( self, archive_file, path ):
-        '''Extract specified file to path'''
-        decompress = subprocess.Popen( [ '7z', 'e', '-y', '-o%s' % path,
-            self.path, archive_file ], stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE )
-        decompress.wait()
-        return "%s/%s" % ( path, archive_file )
+    def stream_command( self, archive_files ):
+        '''Command printing specified files to stdout'''
+        return [ '7z', 'e', '-so', self.path ] + archive_files
 
 class Rar( Archive ):
     '''Rar archive handler'''
     def scan_files( self, ext = 'nds' ):
         '''Scan archive'''
-        list_archive = subprocess.Popen( [ 'unrar', 'lb', self.path ],
+        import subprocess
+        list_archive = subprocess.Popen( [ 'unrar', 'lt', self.path ],
                 stdout = subprocess.PIPE, stderr = subprocess.PIPE )
 
-        for filename in list_archive.stdout.readlines():
-            filename = filename.rstrip()
-            if re.search( "\.%s$" % ext, filename, flags = re.IGNORECASE ):
-                self.file_list.append( filename )
+        filename = None
+        for line in list_archive.stdout.readlines():
+            match = re.match( r"\s*(Name|Type|Size|CRC32): (.*)$",
+                    line.rstrip() )
+            if not match:
+                continue
+            ( key, value ) = match.groups()
+            if key == 'Name':
+                filename = None
+                if re.search( "\.%s$" % ext, value, flags = re.IGNORECASE ):
+                    filename = value
+                    self.file_list.append( filename )
+            elif filename and key == 'Type' and value != 'File':
+                self.file_list.remove( filename )
+                filename = None
+            elif filename and key == 'Size' and value.isdigit():
+                self.sizes[filename] = int( value )
+            elif filename and key == 'CRC32':
+                self.crcs[filename] = int( value, 16 )
         list_archive.wait()
 
-    def extract( self, archive_file, path ):
-        '''Extract specified file to path'''
-        decompress = subprocess.Popen( [ 'unrar', 'x', '-y', self.path,
-            archive_file, path ], stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE )
-        decompress.wait()
-        return "%s/%s" % ( path, archive_file )
+    def stream_command( self, archive_files ):
+        '''Command printing specified files to stdout'''
+        return [ 'unrar', 'p', '-inul', self.path ] + archive_files
+
+class LimitedReader:
+    '''File-like object reading at most size bytes from file_handler'''
+    def __init__( self, file_handler, size ):
+        self.file_handler = file_handler
+        self.left         = size
+
+    def read( self, size = -1 ):
+        '''Read up to size bytes, never past the limit'''
+        if size < 0 or size > self.left:
+            size = self.left
+        data = ''
+        if size:
+            data = self.file_handler.read( size )
+        self.left -= len( data )
+        return data
 
 def archive_obj( path, tmp_dir ):
     '''Create archive object based on path(extension)'''
@@ -551,10 +920,8 @@ def archive_obj( path, tmp_dir ):
 
 def strip_name( name ):
     '''Strip unnecessary information'''
-    name = re.sub( r"(\(|\[)[^\(\)\[\]]*(\)|\])" , ''  , name )
-    name = re.sub( r"(^|\s)(the|and|a|\&)(\s|$)" , ' ' , name )
-    name = re.sub( r"[^\w\d\s]"                  , ''  , name )
-    name = re.sub( r"\s+"                        , ' ' , name )
+    for ( pattern, replacement ) in STRIP_PATTERNS:
+        name = pattern.sub( replacement, name )
     name = name.strip()
 
     return name
@@ -564,14 +931,10 @@ def parse_filename( filename ):
     release_number = None
 
     filename = filename.lower()
-    filename = re.sub( r"^.*(/|:)" , ''  , filename )
-    filename = re.sub( "\.[^.]+$"  , ''  , filename )
-    filename = re.sub( "_"         , ' ' , filename )
+    for ( pattern, replacement ) in FILENAME_PATTERNS:
+        filename = pattern.sub( replacement, filename )
 
-    match = re.match(
-        r"((\[|\()?(\d+)(\]|\))|(\d+)\s*-\s*)\s*(.*)",
-        filename
-    )
+    match = RELEASE_NUMBER_RE.match( filename )
 
     if match:
         if match.group( 3 ):
@@ -582,7 +945,7 @@ def parse_filename( filename ):
             filename       = match.group( 6 )
 
     region = None
-    for tag in re.findall( r"(\(|\[)(\w+)(\)|\])", filename ):
+    for tag in TAG_RE.findall( filename ):
         if not region:
             region = region_code( tag[1] )
 
@@ -590,11 +953,15 @@ def parse_filename( filename ):
 
     return ( release_number, filename, region )
 
+def parse_filenames( filenames ):
+    '''Returns list of parse_filename results for every filename'''
+    return [ parse_filename( filename ) for filename in filenames ]
+
 # FIXME: os.path.splitext
 def extension( file_name ):
     '''Returns the extension of specified file'''
     result = ''
-    match  = re.match( r".*\.([^.]+)$", file_name )
+    match  = EXTENSION_RE.match( file_name )
     if match:
         result = match.group( 1 ).lower()
 
@@ -618,50 +985,397 @@ def byte_to_int( byte_string ):
         ( '\x00' * ( 4 - len( byte_string ) ) )
     )[0]
 
-def search( path, config ):
-    '''Returns list of acceptable files'''
-    result = []
-    log = logging.getLogger( 'pyromgr' )
+def stream_crc( file_handler, crc = 0, size = 0, chunk_size = CHUNK_SIZE,
+        output = None, progress = None ):
+    '''Continue crc32 over the rest of file-like object, returns (crc, size).
+    Data is also written to output and progress is called with size so far
+    when they are given'''
+    chunk = file_handler.read( chunk_size )
+    while chunk:
+        crc   = binascii.crc32( chunk, crc )
+        size += len( chunk )
+        if output:
+            output.write( chunk )
+        if progress:
+            progress( size )
+        chunk = file_handler.read( chunk_size )
+    return ( crc & 0xFFFFFFFF, size )
+
+def list_dir( path ):
+    '''Returns ( path, is_dir, is_link ) for every entry of directory, using
+    file type from directory listing where scandir is available'''
+    if scandir:
+        return [ ( entry.path, entry.is_dir(), entry.is_symlink() ) for
+                entry in scandir( path ) ]
+    return [ ( entry_path, os.path.isdir( entry_path ),
+        os.path.islink( entry_path ) ) for entry_path in
+        [ '%s/%s' % ( path, file_name ) for file_name in os.listdir( path ) ] ]
+
+def walk_files( path, subdirs = True, follow_symlinks = True,
+        one_file_system = False ):
+    '''Yields paths of files under path as soon as they are found. Every
+    directory is visited once, even if reachable through symlinks or bind
+    mounts'''
+    log  = logging.getLogger( 'pyromgr' )
+    path = os.path.abspath( path )
     try:
-        path = os.path.abspath( path )
-        for file_name in os.listdir( path ):
-            file_path = '%s/%s' % ( path, file_name )
-            if os.path.isdir( file_path ):
-                result += search( file_path, config )
+        dir_stat = os.stat( path )
+    except OSError as exc:
+        log.error( "Can't scan path %s: %s" % ( path, exc ) )
+        return
+
+    device  = dir_stat.st_dev
+    visited = set( [ ( dir_stat.st_dev, dir_stat.st_ino ) ] )
+    pending = [ path ]
+    while pending:
+        dir_path = pending.pop()
+        try:
+            entries = list_dir( dir_path )
+        except OSError as exc:
+            log.error( "Can't scan path %s: %s" % ( dir_path, exc ) )
+            continue
+
+        for ( entry_path, is_dir, is_link ) in entries:
+            if is_link and not follow_symlinks:
+                continue
+            if not is_dir:
+                yield entry_path
+            elif subdirs:
+                try:
+                    dir_stat = os.stat( entry_path )
+                except OSError as exc:
+                    log.error( "Can't scan path %s: %s" % ( entry_path, exc ) )
+                    continue
+                dir_id = ( dir_stat.st_dev, dir_stat.st_ino )
+                if dir_id in visited or ( one_file_system and
+                        dir_stat.st_dev != device ):
+                    continue
+                visited.add( dir_id )
+                pending.append( entry_path )
+
+def search( path, config, subdirs = True, follow_symlinks = True,
+        one_file_system = False, database = None ):
+    '''Yields acceptable files, archives are expanded to archive:member
+    paths. Archive listings are cached in database when it is given'''
+    import zipfile
+    log = logging.getLogger( 'pyromgr' )
+    for file_path in walk_files( path, subdirs, follow_symlinks,
+            one_file_system ):
+        ext = extension( file_path )
+        if ext in config.extensions:
+            if ext == 'nds':
+                yield file_path
             else:
-                ext = extension( file_path )
-                if ext in config.extensions:
-                    if ext == 'nds':
-                        result.append( file_path )
+                try:
+                    archive = archive_obj( file_path, config.tmp_dir )
+                    if database:
+                        archive.scan_files_cached( database )
                     else:
-                        try:
-                            archive = archive_obj( file_path, config.tmp_dir )
-                            archive.scan_files()
-                            for arc_path in archive.full_paths():
-                                result.append( arc_path )
-                        except zipfile.BadZipfile as exc:
-                            log.warning( "Failed to scan archive %s: %s" % (
-                                    file_path, exc ) )
+                        archive.scan_files()
+                    for arc_path in archive.full_paths():
+                        yield arc_path
+                except zipfile.BadZipfile as exc:
+                    log.warning( "Failed to scan archive %s: %s" % (
+                            file_path, exc ) )
+
+def file_hash( path, partial = False, chunk_size = CHUNK_SIZE ):
+    '''Returns md5 digest of file, partial hash covers only first and last
+    chunk_size bytes'''
+    md5 = hashlib.md5()
+    with open( path, 'rb' ) as fh:
+        if partial:
+            md5.update( fh.read( chunk_size ) )
+            fh.seek( 0, os.SEEK_END )
+            fh.seek( max( fh.tell() - chunk_size, 0 ) )
+            md5.update( fh.read( chunk_size ) )
+        else:
+            for chunk in iter( lambda: fh.read( chunk_size ), '' ):
+                md5.update( chunk )
+    return md5.digest()
+
+def _hash_buckets( buckets, hash_func ):
+    '''Splits every bucket of paths by hash_func, returns buckets that
+    still contain more than one path'''
+    log    = logging.getLogger( 'pyromgr' )
+    result = []
+    for bucket in buckets:
+        hashes = {}
+        for path in bucket:
+            try:
+                hashes.setdefault( hash_func( path ), [] ).append( path )
+            except ( IOError, OSError ) as exc:
+                log.warning( "Can't read %s: %s" % ( path, exc ) )
+        result += [ paths for paths in hashes.values() if len( paths ) > 1 ]
+    return result
+
+def find_file_dupes( path, extensions = None, subdirs = True,
+        follow_symlinks = True, one_file_system = False,
+        chunk_size = CHUNK_SIZE ):
+    '''Returns lists of identical files under path. Files are bucketed by
+    size, then by hash of their first and last chunk_size bytes and only
+    files with colliding partial hashes are hashed fully'''
+    log   = logging.getLogger( 'pyromgr' )
+    sizes = {}
+    seen  = set()
+    for file_path in walk_files( path, subdirs, follow_symlinks,
+            one_file_system ):
+        if extensions is not None and extension( file_path ) not in extensions:
+            continue
+        try:
+            stat = os.stat( file_path )
+        except OSError as exc:
+            log.warning( "Can't stat %s: %s" % ( file_path, exc ) )
+            continue
+        if not stat.st_size or ( stat.st_dev, stat.st_ino ) in seen:
+            continue
+        seen.add( ( stat.st_dev, stat.st_ino ) )
+        sizes.setdefault( stat.st_size, [] ).append( file_path )
+
+    result = []
+    for ( size, bucket ) in sizes.iteritems():
+        if len( bucket ) < 2:
+            continue
+        buckets = _hash_buckets( [ bucket ], lambda file_path: file_hash(
+            file_path, True, chunk_size ) )
+        if size > 2 * chunk_size:
+            buckets = _hash_buckets( buckets, lambda file_path: file_hash(
+                file_path, False, chunk_size ) )
+        result += buckets
+    return sorted( sorted( bucket ) for bucket in result )
+
+def parse_file( args ):
+    '''Parse single file, returns initialized FileInfo. Runs in pool workers,
+    so takes a single tuple of ( path, tmp_dir, verify, cached, size ), size
+    being the listed size of archive member or None'''
+    ( path, tmp_dir, verify, cached, size ) = args
+    file_info = FileInfo( path, tmp_dir, verify = verify )
+    file_info.init( cached )
+    return file_info
+
+def parse_files( args_list ):
+    '''Parse a group of files given as list of parse_file arguments, returns
+    list of FileInfo. Members of one archive are read in a single archiver
+    run, using member sizes from the arguments instead of listing the archive
+    again'''
+    result  = []
+    members = {}
+    archive = None
+    for args in args_list:
+        ( path, tmp_dir, verify, cached, size ) = args
+        if cached or len( args_list ) == 1 or ':' not in path:
+            result.append( parse_file( args ) )
+        else:
+            if archive is None:
+                archive = archive_obj( path.split( ':' )[0], tmp_dir )
+            file_info = FileInfo( path, tmp_dir, verify = verify )
+            file_info.fingerprint = fingerprint( path )
+            name = file_info._split_path()[1]
+            members[name] = file_info
+            if size is not None:
+                archive.file_list.append( name )
+                archive.sizes[name] = size
+
+    if members:
+        for ( name, nds ) in archive.iter_nds( members.keys(), verify ):
+            members[name].init( nds = nds )
+            result.append( members[name] )
+    return result
+
+def group_candidates( candidates ):
+    '''Groups consecutive parse_file arguments by archive path'''
+    for ( archive_path, group ) in itertools.groupby( candidates,
+            lambda args: args[0].split( ':' )[0] ):
+        yield list( group )
+
+def listed_known_crc( path, database ):
+    '''( size, crc ) of archive member from archive listing, if the crc
+    belongs to a known rom, so the member does not need decompressing'''
+    result = None
+    if ':' in path:
+        listed = database.listed_crc( *path.split( ':', 1 ) )
+        if listed and listed[1] is not None and \
+                database.search_crc( listed[1], 'known' ):
+            result = listed
+    return result
+
+def import_candidates( path, opts, database, config ):
+    '''Yields parse_file arguments for files that need to be imported, with
+    crc and size from fingerprint cache for files that did not change'''
+    full_rescan = opts and opts.full_rescan
+    verify      = opts and opts.verify
+    for rom_path in search( path, config,
+            subdirs = not ( opts and opts.no_subdirs ),
+            follow_symlinks = not ( opts and opts.no_symlinks ),
+            one_file_system = opts and opts.one_file_system,
+            database = database ):
+        if full_rescan or not database.already_in_local( rom_path, 1 ):
+            cached = None
+            size   = None
+            if not verify:
+                cached = database.cached_crc( fingerprint( rom_path ) ) or \
+                        listed_known_crc( rom_path, database )
+            if ':' in rom_path:
+                listed = database.listed_crc( *rom_path.split( ':', 1 ) )
+                if listed:
+                    size = listed[0]
+            yield ( rom_path, config.tmp_dir, verify, cached, size )
+
+def map_files( func, iterable, jobs = 1, processes = False ):
+    '''Lazily map func over iterable using jobs threads or processes,
+    results are yielded in order of completion'''
+    import multiprocessing, multiprocessing.pool
+    if jobs <= 1:
+        for item in iterable:
+            yield func( item )
+        return
+
+    if processes:
+        pool = multiprocessing.Pool( jobs )
+    else:
+        pool = multiprocessing.pool.ThreadPool( jobs )
+    try:
+        for result in pool.imap_unordered( func, iterable ):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _missing_in_dir( args ):
+    '''Returns paths of group whose files are not listed in directory'''
+    ( directory, group ) = args
+    try:
+        present = set( os.listdir( directory or '.' ) )
     except OSError as exc:
-        log.error( "Can't scan path %s: %s" % ( path, exc ) )
+        if exc.errno not in ( errno.ENOENT, errno.ENOTDIR ):
+            log = logging.getLogger( 'pyromgr' )
+            log.warning( "Can't list %s: %s" % ( directory, exc ) )
+            return []
+        present = set()
+    return [ path for ( file_name, path ) in group if
+            file_name not in present ]
+
+def missing_paths( path_list, jobs = 1 ):
+    '''Returns paths from path_list whose files no longer exist. Archive
+    members are checked by archive path, every directory is listed only once
+    and directories are checked by jobs threads'''
+    groups = {}
+    for path in path_list:
+        ( directory, file_name ) = os.path.split( path.split( ':' )[0] )
+        groups.setdefault( directory, [] ).append( ( file_name, path ) )
+
+    result = []
+    for missing in map_files( _missing_in_dir, groups.iteritems(), jobs ):
+        result += missing
     return result
 
-def import_path( path, opts, database, config, ui_handler ):
-    '''Import roms from path'''
+def import_path( path, opts, database, config, ui_handler, index = None ):
+    '''Import roms from path, roms are identified using index if given'''
     rom_queue = Queue.Queue()
-    adder = AddWorker( rom_queue )
+    adder = AddWorker( rom_queue, database )
     adder.daemon = True
     adder.start()
 
+    jobs        = ( opts and opts.jobs ) or 1
+    processes   = opts and opts.processes
+    # candidates may be generated on a pool thread while adder commits, so
+    # the scan gets a connection of its own
+    candidates  = group_candidates( import_candidates( path, opts,
+        database.connect(), config ) )
+
     log = logging.getLogger( 'pyromgr' )
-    for rom_path in search( path, config ):
-        rom = Rom( rom_path, database, config, ui_handler )
-        if ( opts and opts.full_rescan ) or not rom.is_in_db():
+    for file_list in map_files( parse_files, candidates, jobs, processes ):
+        for file_info in file_list:
+            rom = Rom( file_info.path, database, config, ui_handler,
+                    file_info = file_info, index = index )
             if rom.is_valid():
                 rom_queue.put( rom )
             else:
-                log.warning( 'File is invalid: %s' % rom_path )
+                log.warning( 'File is invalid: %s' % file_info.path )
+    rom_queue.put( None )
     rom_queue.join()
+    database.save()
+
+    if not ( opts and opts.non_interactive ):
+        resolve_pending( database, config, ui_handler, index )
+
+def resolve_pending( database, config, ui_handler, index = None ):
+    '''Ask user to identify roms left in pending table'''
+    for ( path, size, crc ) in database.pending_list():
+        if fingerprint( path ):
+            file_info = FileInfo( path, config.tmp_dir )
+            file_info.init( ( size, crc ) )
+            rom = Rom( path, database, config, ui_handler,
+                    file_info = file_info, index = index )
+            database.add_local( rom.local_info() )
+        database.remove_pending( [ path ] )
+        database.save()
+
+def read_manifest( path ):
+    '''Returns { filename : manifest entry } of roms synced to path'''
+    import json
+    manifest = {}
+    try:
+        with open( os.path.join( path, MANIFEST_NAME ) ) as file_handler:
+            manifest = json.load( file_handler )['files']
+    except IOError:
+        pass
+    except ( ValueError, KeyError, TypeError ) as exc:
+        log = logging.getLogger( 'pyromgr' )
+        log.warning( 'Ignoring broken manifest in %s: %s' % ( path, exc ) )
+    return manifest
+
+def write_manifest( path, manifest ):
+    '''Atomically replaces manifest of path'''
+    import json
+    manifest_path = os.path.join( path, MANIFEST_NAME )
+    with open( '%s.tmp' % manifest_path, 'w' ) as file_handler:
+        json.dump( { 'version' : 1, 'files' : manifest }, file_handler,
+                indent = 1, sort_keys = True )
+    os.rename( '%s.tmp' % manifest_path, manifest_path )
+
+def sync_roms( rom_list, path, delete = False, progress = None ):
+    '''Uploads roms that are missing on path or differ from its manifest,
+    with delete roms uploaded earlier and not in rom_list are removed.
+    progress is passed to Rom.upload. Returns ( copied, unchanged, deleted )
+    counts'''
+    log      = logging.getLogger( 'pyromgr' )
+    manifest = read_manifest( path )
+    # rom filenames and manifest keys are unicode, so listing has to be too
+    if isinstance( path, str ):
+        present = set( os.listdir( path.decode(
+            sys.getfilesystemencoding() ) ) )
+    else:
+        present = set( os.listdir( path ) )
+    wanted   = {}
+    for rom_obj in rom_list:
+        wanted.setdefault( rom_obj.rom_info.filename, rom_obj )
+
+    ( copied, unchanged, deleted ) = ( 0, 0, 0 )
+    try:
+        if delete:
+            for filename in sorted( set( manifest ) - set( wanted ) ):
+                if filename in present:
+                    log.info( 'Removing %s' % filename )
+                    os.unlink( os.path.join( path, filename ) )
+                del manifest[filename]
+                deleted += 1
+
+        for ( filename, rom_obj ) in sorted( wanted.iteritems() ):
+            entry = rom_obj.manifest_entry()
+            if manifest.get( filename ) == entry and filename in present and \
+                    os.path.getsize( os.path.join( path, filename ) ) == \
+                    entry['size']:
+                unchanged += 1
+                continue
+            log.info( 'Uploading %s' % filename )
+            manifest.pop( filename, None )
+            if rom_obj.upload( path, progress ):
+                manifest[filename] = entry
+                copied += 1
+    finally:
+        write_manifest( path, manifest )
+    return ( copied, unchanged, deleted )
 
 def get_save( path, save_ext = 'sav' ):
     '''Search for savefile of given rom'''
@@ -686,15 +1400,32 @@ def identify( path, database ):
         if id_list and len( id_list ) == 1:
             local_id = id_list[0]
         else:
-            file_handler = open( path, 'rb' )
-            crc = binascii.crc32( file_handler.read() ) & 0xFFFFFFFF
-            file_handler.close()
+            file_stat = fingerprint( path )
+            cached    = database.cached_crc( file_stat )
+            if cached:
+                crc = cached[1]
+            else:
+                file_handler = open( path, 'rb' )
+                ( crc, size ) = stream_crc( file_handler )
+                file_handler.close()
+                database.add_fingerprints( [ file_stat + ( size, crc ) ] )
             id_list = database.search_local( 'id', 'crc', crc )
             if id_list:
                 local_id = id_list[0]
 
     return local_id
 
+def fingerprint( path ):
+    '''Stat based fingerprint ( path, member, size, mtime_ns, inode, device ),
+    archive members share the stat of their archive. None if file is missing'''
+    ( file_path, member ) = ( path.split( ':', 1 ) + [ '' ] )[:2]
+    try:
+        stat = os.stat( file_path )
+    except OSError:
+        return None
+    return ( file_path, member, stat.st_size,
+            int( stat.st_mtime * 1000000000 ), stat.st_ino, stat.st_dev )
+
 def mkdir( path ):
     '''Create dir if not exists'''
     if not os.path.exists( path ):
@@ -1,5 +1,5 @@
 '''User interface routines for pyromanager'''
-import cmdln, os, re
+import cmdln, os, re, itertools, sys
 import db, cfg, rom
 import logging
 
@@ -11,6 +11,35 @@ def verbose( self, opt, value, parser, *args, **kwargs ):
     log.setLevel( logging.DEBUG )
 
 
+LIST_FIELDS = [ 'relid', 'name', 'region', 'publisher', 'released_by', 'path',
+        'size', 'crc' ]
+
+def rom_record( row ):
+    '''Dict with LIST_FIELDS from SQLdb.iter_local_roms row'''
+    ( release_id, path, size, crc, relid, name, publisher, released_by,
+            region, search_name ) = row
+    return {
+        'relid'       : release_id,
+        'name'        : name,
+        'region'      : cfg.region_name( region ) if relid else None,
+        'publisher'   : publisher,
+        'released_by' : released_by,
+        'path'        : path,
+        'size'        : size,
+        'crc'         : crc,
+    }
+
+def json_record( row ):
+    '''Format SQLdb.iter_local_roms row as json object'''
+    import json
+    return json.dumps( rom_record( row ), sort_keys = True )
+
+def tsv_value( value ):
+    '''Format value as tsv field'''
+    if value is None:
+        value = ''
+    return re.sub( r"[\t\n]", ' ', unicode( value ) )
+
 def colorize( msg, colorid = 0 ):
     '''Colorize string'''
     return "\x1b[%i;01m%s\x1b[39;49;00m" % ( colorid, msg )
@@ -42,10 +71,21 @@ class Cli( cmdln.Cmdln ):
     @cmdln.alias( "i", "im" )
     @cmdln.option( "--no-subdirs", action = "store_true",
             help = "do not scan subdirs" )
+    @cmdln.option( "--no-symlinks", action = "store_true",
+            help = "do not follow symlinks" )
+    @cmdln.option( "--one-file-system", action = "store_true",
+            help = "do not descend into other filesystems" )
     @cmdln.option( "--non-interactive", action = "store_true",
-            help = "do not ask any questions(probably a bad idea)" )
+            help = "do not ask any questions, unidentified roms are left " + \
+                    "for resolve command" )
     @cmdln.option( "-r", "--full-rescan", action = "store_true",
             help = "readd files even if already in db" )
+    @cmdln.option( "--verify", action = "store_true",
+            help = "fully decompress archived roms and check their crc" )
+    @cmdln.option( "-j", "--jobs", type = "int", default = 1,
+            help = "number of files to read and checksum in parallel" )
+    @cmdln.option( "--processes", action = "store_true",
+            help = "use worker processes instead of threads for --jobs" )
     def do_import( self, subcmd, opts, path ):
         """${cmd_name}: import roms from dir into database
 
@@ -53,25 +93,60 @@ class Cli( cmdln.Cmdln ):
         ${cmd_option_list}
         """
 
-        rom.import_path( path, opts, self.database, self.config, self )
+        rom.import_path( path, opts, self.database, self.config, self,
+                db.KnownIndex( self.database ) )
+
+    @cmdln.alias( "res" )
+    def do_resolve( self, subcmd, opts ):
+        """${cmd_name}: identify roms that import could not identify by itself
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        """
+
+        rom.resolve_pending( self.database, self.config, self,
+                db.KnownIndex( self.database ) )
 
     @cmdln.alias( "l", "ls" )
     @cmdln.option( "-k", "--known", action = "store_true",
             help = "query known roms, not the local ones" )
+    @cmdln.option( "--limit", type = "int",
+            help = "print at most LIMIT roms" )
+    @cmdln.option( "--offset", type = "int", default = 0,
+            help = "skip first OFFSET roms" )
+    @cmdln.option( "--sort", choices = sorted( db.SORT_COLUMNS.keys() ),
+            default = "id", help = "sort roms by: %s (default: id)" %
+            ', '.join( sorted( db.SORT_COLUMNS.keys() ) ) )
+    @cmdln.option( "--format", choices = [ "text", "json", "ndjson", "tsv" ],
+            default = "text", help = "output format: text, json, ndjson or " + \
+                    "tsv (default: text)" )
     def do_list( self, subcmd, opts, *terms ):
         """${cmd_name}: query db for roms
 
         ${cmd_usage}
         ${cmd_option_list}
         """
-        if not terms:
-            terms = [ '%' ]
-        for term in terms:
-            for local_id in self.database.search_name( term, table = 'local' ):
-                rom_obj = rom.Rom( None, self.database, self.config, self,
-                        file_info = rom.FileInfo( None, self.config.tmp_dir,
-                            self.database.file_info( local_id ) ) )
-                print rom_obj
+        rows = self.database.iter_local_roms( terms, opts.limit, opts.offset,
+                opts.sort )
+        if opts.format == 'text':
+            for row in rows:
+                print rom.rom_from_row( row, self.database, self.config, self )
+        elif opts.format == 'tsv':
+            print '\t'.join( LIST_FIELDS )
+            for row in rows:
+                record = rom_record( row )
+                sys.stdout.write( '\t'.join( [ tsv_value( record[field] ) for
+                    field in LIST_FIELDS ] ).encode( 'utf-8' ) + '\n' )
+        elif opts.format == 'ndjson':
+            for row in rows:
+                sys.stdout.write( json_record( row ) + '\n' )
+        else:
+            separator = '\n'
+            sys.stdout.write( '[' )
+            for row in rows:
+                sys.stdout.write( separator + json_record( row ) )
+                separator = ',\n'
+            sys.stdout.write( '\n]\n' )
 
     @cmdln.alias( "u", "up" )
     def do_upload( self, subcmd, opts, name, *path ):
@@ -84,15 +159,11 @@ class Cli( cmdln.Cmdln ):
         if not path:
             path = self.config.flashcart
 
-        rom_list = map(
-                lambda id: rom.Rom( None, self.database, self.config, self,
-                    file_info = rom.FileInfo( None, self.config.tmp_dir,
-                        self.database.file_info( id ) ) ),
-                self.database.search_name( name, table = 'local' )
-        )
+        rom_list = [ rom.rom_from_row( row, self.database, self.config, self )
+                for row in self.database.local_roms( name ) ]
         answer = self.list_question( "Possible roms:", rom_list, "Which one?" )
         if answer != None:
-            rom_list[answer].upload( path )
+            rom_list[answer].upload( path, self.upload_progress )
             save_list = rom_list[answer].get_saves()
             if save_list:
                 answer = self.list_question( "Savefiles found for this rom:",
@@ -100,22 +171,71 @@ class Cli( cmdln.Cmdln ):
                 if answer != None:
                     save_list[answer].upload( path )
 
+    @cmdln.option( "-p", "--path",
+            help = "sync to PATH instead of flashcart mountpoint" )
+    @cmdln.option( "-l", "--list", dest = "list_file", metavar = "FILE",
+            help = "read query terms from FILE, one per line" )
+    @cmdln.option( "-d", "--delete", action = "store_true",
+            help = "remove roms synced earlier that are not selected anymore" )
+    def do_sync( self, subcmd, opts, *terms ):
+        """${cmd_name}: mirror selected roms to flashcart, only missing and
+        changed roms are copied. All identified roms are selected when no
+        terms are given
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        """
+        path  = opts.path or self.config.flashcart
+        if not os.path.isdir( path ):
+            log.error( "Flashcart directory %s is not available" % path )
+            return 1
+        terms = list( terms )
+        if opts.list_file:
+            with open( opts.list_file ) as file_handler:
+                terms += [ line.strip() for line in file_handler if
+                        line.strip() and not line.startswith( '#' ) ]
+            if not terms:
+                log.error( "No roms selected in %s" % opts.list_file )
+                return 1
+
+        rom_list = [ rom.rom_from_row( row, self.database, self.config, self )
+                for row in self.database.iter_local_roms( terms ) if
+                row[4] is not None ]
+        log.info( "%d roms copied, %d up to date, %d removed" %
+                rom.sync_roms( rom_list, path, opts.delete,
+                    self.upload_progress ) )
+
     @cmdln.alias( "rd" )
+    @cmdln.option( "-s", "--scan", metavar = "PATH",
+            help = "find identical files under PATH instead of using db" )
     def do_rmdupes( self, subcmd, opts ):
         """${cmd_name}: remove duplicate roms from disk
 
         ${cmd_usage}
         ${cmd_option_list}
         """
-        for ( entries, crc ) in self.database.find_dupes():
-            rom_list = map(
-                    lambda id: rom.Rom( None, self.database, self.config, self,
-                        file_info = rom.FileInfo( None, self.config.tmp_dir,
-                            self.database.file_info( id ) ) ),
-                    self.database.search_crc( crc, table = 'local' )
-            )
-
-            pre_msg = "%d duplicates found for *%s*\n" % ( entries,
+        if opts.scan:
+            for path_list in rom.find_file_dupes( opts.scan,
+                    self.config.extensions ):
+                pre_msg = "%d identical files found for *%s*\n" % (
+                        len( path_list ), path_list[0] ) + \
+                        "Delete all but one(None - let all be)"
+                answer = self.list_question( pre_msg, path_list, "Which one?" )
+                if answer != None:
+                    del path_list[answer]
+                    for path in path_list:
+                        os.unlink( path )
+                        self.database.remove_local( path )
+                    self.database.save()
+                print
+            return
+
+        for ( crc, rows ) in itertools.groupby( self.database.dupe_roms(),
+                lambda row: row[3] ):
+            rom_list = [ rom.rom_from_row( row, self.database, self.config,
+                self ) for row in rows ]
+
+            pre_msg = "%d duplicates found for *%s*\n" % ( len( rom_list ),
                     rom_list[0] ) + "Delete all but one(None - let all be)"
             answer = self.list_question( pre_msg, rom_list, "Which one?" )
             if answer != None:
@@ -136,13 +256,17 @@ class Cli( cmdln.Cmdln ):
         """
 
         xml = db.AdvansceneXML()
-        if xml.update( self.database, self.config.tmp_dir ) or opts.force:
-            self.database.save()
+        updated = xml.update( self.database, self.config.tmp_dir, opts.force )
+        # update time is refreshed even if nothing changed
+        self.database.save()
+        if updated:
             log.info( "Database updated" )
         else:
             log.info( "Already up to date" )
 
     @cmdln.alias( "c", "cdb" )
+    @cmdln.option( "-j", "--jobs", type = "int", default = 1,
+            help = "check JOBS directories in parallel (default: 1)" )
     def do_cleandb( self, subcmd, opts ):
         """${cmd_name}: Find and remove from db files that are no longer
         present
@@ -151,10 +275,8 @@ class Cli( cmdln.Cmdln ):
         ${cmd_option_list}
         """
 
-        for path in self.database.path_list():
-            path = path.split( ':' )[0]
-            if not os.path.exists( path ):
-                self.database.remove_local( path )
+        self.database.remove_local_many( rom.missing_paths(
+            self.database.path_list(), opts.jobs ) )
         self.database.save()
 
     @cmdln.alias( "bs" )
@@ -170,7 +292,8 @@ class Cli( cmdln.Cmdln ):
         else:
             path = self.config.flashcart
 
-        for nds_path in rom.search( path, self.config ):
+        for nds_path in rom.search( path, self.config,
+                database = self.database ):
             save_path = rom.get_save( nds_path, self.config.save_ext )
             if save_path:
                 local_id = rom.identify( nds_path, self.database )
@@ -187,6 +310,15 @@ class Cli( cmdln.Cmdln ):
                     if not save.stored():
                         log.info( "Backing up %s %s" % ( save_path, save ) )
                         save.copy_from( save_path )
+        self.database.save()
+
+    def upload_progress( self, size, total ):
+        '''Show upload progress on terminal'''
+        if total and sys.stderr.isatty():
+            sys.stderr.write( '\r%3d%% %.2fM/%.2fM' % ( size * 100 / total,
+                size / 1048576.0, total / 1048576.0 ) )
+            if size >= total:
+                sys.stderr.write( '\n' )
 
     def highlight( self, msg ):
         result = msg
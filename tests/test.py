@@ -1,5 +1,11 @@
 import unittest
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
 import pyromanager.cfg
 import pyromanager.db
 import pyromanager.rom
@@ -26,6 +32,15 @@ class cfg_test( unittest.TestCase ):
         self.assertFalse( pyromanager.cfg.is_bin_available(
             'there_is_no_way_this_is_in_your_path' ) )
 
+    def test_lazy_imports( self ):
+        heavy = [ 'urllib2', 'zipfile', 'subprocess', 'multiprocessing',
+                'xml.etree.cElementTree', 'json' ]
+        output = subprocess.check_output( [ sys.executable, '-c',
+            'import sys, pyromanager.cfg, pyromanager.db, pyromanager.rom; ' +
+            'print " ".join( sorted( set( %r ) & set( sys.modules ) ) )' %
+            heavy ] )
+        self.assertEqual( output.strip(), '' )
+
     def test_regions( self ):
         self.assertEqual( pyromanager.cfg.region_name( 0 ), 'EUR' )
         self.assertEqual( pyromanager.cfg.region_name( 0, 0 ), 'Europe' )
@@ -38,6 +53,7 @@ class cfg_test( unittest.TestCase ):
         self.assertEqual( pyromanager.cfg.region_code( 'JPN' ), 7 )
         self.assertEqual( pyromanager.cfg.region_code( 'J' ), 7 )
         self.assertEqual( pyromanager.cfg.region_code( 'Zimbabwe' ), None )
+        self.assertEqual( pyromanager.cfg.region_code( 'dutch' ), 8 )
 
     def test_rc( self ):
         config = pyromanager.cfg.Config( 'tests/test.rc' )
@@ -70,7 +86,18 @@ class db_test( unittest.TestCase ):
         self.assertTupleEqual( xmldb[0], (4710, u'Coropata', 3076538459L,
             u'LukPlus', u'BAHAMUT', 7, u'coropata') )
 
-        self.db.import_known( xmldb )
+        self.assertListEqual( list( pyromanager.db.AdvansceneXML(
+            'tests/nds.xml' ) ), xmldb.rom_list, 'Streamed parse' )
+
+        self.assertEqual( xmldb.dat_version, '1683' )
+        self.assertTupleEqual( self.db.import_known( xmldb ), ( 7, 0, 0 ) )
+        self.assertEqual( self.db.dat_version, '1683' )
+        self.db.database.execute( 'DELETE FROM db_info WHERE key = "u_time"' )
+        self.assertTupleEqual( self.db.import_known( xmldb ), ( 0, 0, 7 ),
+                'Same dat version' )
+        self.assertTrue( self.db.last_updated > 0 )
+        self.assertTupleEqual( self.db.import_known( xmldb.rom_list ),
+                ( 0, 0, 7 ), 'Unchanged rows' )
 
         self.assertListEqual( self.db.search_crc( 3076538459L ), [ 4710 ] )
         self.assertListEqual( self.db.search_crc( 3976938459L ), [] )
@@ -82,6 +109,25 @@ class db_test( unittest.TestCase ):
         self.assertListEqual( self.db.search_name( 'ropat', 7 ), [ 4710 ],
                 'Partial name with region' )
         self.assertListEqual( self.db.search_name( 'No its not' ), [] )
+        self.assertTrue( self.db.name_index )
+        self.db.import_known( [ ( 4710, u'Coropata', 3076538459L, u'LukPlus',
+            u'BAHAMUT', 7, u'renamed' ) ] )
+        self.assertListEqual( self.db.search_name( 'ropat' ), [],
+                'Name index follows replaced rows' )
+        self.assertListEqual( self.db.search_name( 'renamed' ), [ 4710 ] )
+        self.assertTupleEqual( self.db.import_known( xmldb.rom_list ),
+                ( 0, 1, 6 ), 'Changed row' )
+
+        index = pyromanager.db.KnownIndex( self.db )
+        for ( name, region ) in [ ( 'Coropata', None ), ( 'ropat', 7 ),
+                ( 'ropat', 1 ), ( 'No its not', None ), ( 'a', None ),
+                ( 'last window', None ), ( 'j_g%pix', None ), ( '', None ) ]:
+            self.assertListEqual( index.search_name( name, region ),
+                    self.db.search_name( name, region ), name )
+        self.assertListEqual( index.search_crc( 3076538459L ), [ 4710 ] )
+        self.assertTupleEqual( index.rom_info( 4710 ),
+                self.db.rom_info( 4710 ) )
+        self.assertTupleEqual( index.rom_info( 1 ), self.db.rom_info( 1 ) )
 
         self.assertTupleEqual( self.db.rom_info( 4710 ), (4710, u'Coropata',
             u'LukPlus', u'BAHAMUT', 7, u'coropata') )
@@ -100,6 +146,39 @@ class db_test( unittest.TestCase ):
         self.db.add_local( ( 9823, '/some/path/to/yet_another_file.nds',
             'dupe', 1231, 9812312 ) )
         self.assertListEqual( self.db.find_dupes(), [ (2, 9812312) ] )
+        self.assertListEqual( self.db.search_name( 'dupe', table = 'local' ),
+                [ 3 ] )
+
+        self.db.add_local_many( [
+            ( 9824, '/some/path/to/batch_one.nds', 'batch one', 99, 1 ),
+            ( 9825, '/some/path/to/batch_two.nds', 'batch two', 99, 2 ) ] )
+        self.assertListEqual( self.db.search_local( 'release_id', 'size', 99 ),
+            [ 9824, 9825 ] )
+        self.db.remove_local( '/some/path/to/batch_one.nds' )
+        self.db.remove_local( '/some/path/to/batch_two.nds' )
+
+        self.db.add_local_many( [
+            ( 9826, '/some/path/to/arc.zip:a.nds', 'arc a', 98, 1 ),
+            ( 9827, '/some/path/to/arc.zip.nds', 'arc nds', 98, 2 ) ] )
+        self.db.remove_local( '/some/path/to/arc.zip' )
+        self.assertListEqual( self.db.search_local( 'release_id', 'size', 98 ),
+            [ 9827 ] )
+        self.db.remove_local_many( [ '/some/path/to/arc.zip.nds' ] )
+        self.assertListEqual( self.db.search_local( 'release_id', 'size', 98 ),
+            [] )
+
+        self.assertListEqual( [ row[1] for row in self.db.dupe_roms() ], [
+            '/some/path/to/file.nds', '/some/path/to/yet_another_file.nds' ] )
+        self.assertListEqual( self.db.local_roms( 'dupe' ), [ ( 9823,
+            '/some/path/to/yet_another_file.nds', 1231, 9812312 ) +
+            ( None, ) * 6 ] )
+
+        self.assertListEqual( [ row[1] for row in self.db.iter_local_roms(
+            [ 'dupe', 'something else' ], sort = 'path' ) ], [
+                '/some/path/to/other_file.nds',
+                '/some/path/to/yet_another_file.nds' ] )
+        self.assertListEqual( [ row[0] for row in self.db.iter_local_roms(
+            limit = 1, offset = 1 ) ], [ 9821 ] )
 
         self.db.remove_local( '/some/path/to/yet_another_file.nds' )
         self.assertListEqual( self.db.find_dupes(), [] )
@@ -111,6 +190,59 @@ class db_test( unittest.TestCase ):
         self.assertTrue( self.db.already_in_local( '/some/path/to/file.nds' ) )
         self.assertFalse( self.db.already_in_local( '/wrong/path/to/file.nds' ) )
 
+    def test_update( self ):
+        import urllib2, zipfile, StringIO
+        data = StringIO.StringIO()
+        archive = zipfile.ZipFile( data, 'w' )
+        archive.write( 'tests/nds.xml', 'nds.xml' )
+        archive.close()
+
+        class FakeResponse:
+            def info( self ):
+                return self
+            def getheader( self, name ):
+                return 'Mon, 01 Jan 2001 00:00:00 GMT'
+            def read( self ):
+                return data.getvalue()
+
+        tmp_dir = tempfile.mkdtemp()
+        urlopen = urllib2.urlopen
+        urllib2.urlopen = lambda url: FakeResponse()
+        try:
+            xml = pyromanager.db.AdvansceneXML()
+            self.assertTrue( xml.update( self.db, tmp_dir, True ) )
+            self.assertFalse( pyromanager.db.AdvansceneXML().update( self.db,
+                tmp_dir, True ) )
+            self.assertFalse( pyromanager.db.AdvansceneXML().update( self.db,
+                tmp_dir ) )
+            self.assertListEqual( os.listdir( tmp_dir ), [] )
+        finally:
+            urllib2.urlopen = urlopen
+            shutil.rmtree( tmp_dir )
+
+    def test_connect( self ):
+        other = self.db.connect()
+        self.assertIsNot( other.database, self.db.database )
+        other.store_archive_listing( '/some/archive.7z', 10, 20, [
+            ( 'a.nds', 352, 516824321 ) ] )
+        other.save()
+        self.assertListEqual( self.db.archive_listing( '/some/archive.7z', 10,
+            20 ), [ ( 'a.nds', 352, 516824321 ) ] )
+
+    def test_migrate( self ):
+        self.assertEqual( self.db.schema_version,
+                pyromanager.db.SCHEMA_VERSION )
+        self.db.database.execute( 'DROP INDEX known_crc' )
+        self.db.database.execute( 'DELETE FROM db_info' )
+        self.db.save()
+        del( self.db )
+
+        self.db = pyromanager.db.SQLdb( self.config.db_file )
+        self.assertEqual( self.db.schema_version,
+                pyromanager.db.SCHEMA_VERSION )
+        self.assertIn( ( 'known_crc', ), self.db.database.execute(
+            'SELECT name FROM sqlite_master WHERE type = "index"' ).fetchall() )
+
 class rom_test( unittest.TestCase ):
     def setUp( self ):
         self.config = pyromanager.cfg.Config( 'tests/test.rc' )
@@ -160,6 +292,15 @@ class rom_test( unittest.TestCase ):
         self.assertTrue( finfo.is_archived() )
         self.assertTrue( finfo.is_valid() )
         self.assertEqual( finfo.normalized_name, 'tinyfb' )
+        self.assertEqual( finfo.size, 352 )
+        self.assertEqual( finfo.crc, 516824321L )
+
+    def test_FileInfo_archive_verify( self ):
+        finfo = pyromanager.rom.FileInfo( 'tests/TinyFB.zip:TinyFB.nds',
+                self.config.tmp_dir, verify = True )
+        self.assertTrue( finfo.is_valid() )
+        self.assertEqual( finfo.size, 352 )
+        self.assertEqual( finfo.crc, 516824321L )
 
     def test_FileInfo_lid( self ):
         self.db.add_local( ( 4999, '/some/path/to/file.nds', 'something',
@@ -187,6 +328,107 @@ class rom_test( unittest.TestCase ):
         self.assertEqual( romobj.__str__(), '999999 - TinyFB - TestRom ' + \
                 '(USA) [Independent] 0.00M' )
 
+        romobj = pyromanager.rom.rom_from_row( self.db.local_roms( 'tiny' )[0],
+                self.db, self.config )
+        self.assertEqual( romobj.__str__(), '999999 - TinyFB - TestRom ' + \
+                '(USA) [Independent] 0.00M' )
+
+    def test_Rom_index( self ):
+        index  = pyromanager.db.KnownIndex( self.db )
+        romobj = pyromanager.rom.Rom( 'tests/TinyFB.nds', self.db, self.config,
+                index = index )
+        self.assertIs( romobj.known, index )
+        self.assertEqual( romobj.local_info( interactive = False ), (
+            999999, os.path.abspath( 'tests/TinyFB.nds' ), 'tinyfb testrom',
+            352, 516824321L ) )
+        self.assertIsNone( pyromanager.rom.Rom( 'tests/fake.nds', self.db,
+            self.config, index = index ).local_info( interactive = False ) )
+
+    def test_sync( self ):
+        pyromanager.rom.Rom( 'tests/TinyFB.nds', self.db,
+                self.config ).add_to_db()
+        rom_list = [ pyromanager.rom.rom_from_row( self.db.local_roms(
+            'tiny' )[0], self.db, self.config ) ]
+        flashcart = tempfile.mkdtemp()
+        try:
+            open( '%s/other.nds' % flashcart, 'w' ).close()
+            self.assertTupleEqual( pyromanager.rom.sync_roms( rom_list,
+                flashcart ), ( 1, 0, 0 ) )
+            self.assertEqual( os.path.getsize( '%s/%s' % ( flashcart,
+                rom_list[0].rom_info.filename ) ), 352 )
+            self.assertDictEqual( pyromanager.rom.read_manifest( flashcart ), {
+                rom_list[0].rom_info.filename : { 'relid' : 999999,
+                    'size' : 352, 'crc' : 516824321 } } )
+            self.assertTupleEqual( pyromanager.rom.sync_roms( rom_list,
+                flashcart ), ( 0, 1, 0 ) )
+
+            self.assertTupleEqual( pyromanager.rom.sync_roms( [], flashcart ),
+                    ( 0, 0, 0 ) )
+            self.assertTupleEqual( pyromanager.rom.sync_roms( [], flashcart,
+                True ), ( 0, 0, 1 ) )
+            self.assertListEqual( sorted( os.listdir( flashcart ) ), [
+                pyromanager.rom.MANIFEST_NAME, 'other.nds' ] )
+        finally:
+            shutil.rmtree( flashcart )
+
+    def test_sync_unicode( self ):
+        name = u'Pok\xe9mon TinyFB'
+        try:
+            name.encode( sys.getfilesystemencoding() )
+        except UnicodeEncodeError:
+            self.skipTest( 'file system encoding can not store %r' % name )
+
+        rom_list = [ pyromanager.rom.rom_from_row( ( 999999,
+            os.path.abspath( 'tests/TinyFB.nds' ), 352, 516824321, 999999,
+            name, u'SEGA', u'Independent', 1, u'pokemon tinyfb' ), self.db,
+            self.config ) ]
+        flashcart = tempfile.mkdtemp()
+        try:
+            self.assertTupleEqual( pyromanager.rom.sync_roms( rom_list,
+                flashcart ), ( 1, 0, 0 ) )
+            self.assertTupleEqual( pyromanager.rom.sync_roms( rom_list,
+                flashcart ), ( 0, 1, 0 ) )
+            self.assertTupleEqual( pyromanager.rom.sync_roms( [], flashcart,
+                True ), ( 0, 0, 1 ) )
+            self.assertListEqual( os.listdir( flashcart ), [
+                pyromanager.rom.MANIFEST_NAME ] )
+        finally:
+            shutil.rmtree( flashcart )
+
+    def test_upload( self ):
+        flashcart = tempfile.mkdtemp()
+        try:
+            for path in ( 'tests/TinyFB.nds', 'tests/TinyFB.zip:TinyFB.nds' ):
+                sizes = []
+                finfo = pyromanager.rom.FileInfo( None, self.config.tmp_dir,
+                        ( 999999, os.path.abspath( path ), 352, 516824321 ) )
+                self.assertTrue( finfo.upload( flashcart, 'up.nds',
+                    lambda size, total: sizes.append( ( size, total ) ) ) )
+                self.assertEqual( sizes[-1], ( 352, 352 ) )
+                self.assertEqual( open( '%s/up.nds' % flashcart, 'rb' ).read(),
+                        open( 'tests/TinyFB.nds', 'rb' ).read() )
+
+                finfo = pyromanager.rom.FileInfo( None, self.config.tmp_dir,
+                        ( 999999, os.path.abspath( path ), 352, 1 ) )
+                self.assertFalse( finfo.upload( flashcart, 'bad.nds' ) )
+            self.assertListEqual( os.listdir( flashcart ), [ 'up.nds' ] )
+        finally:
+            shutil.rmtree( flashcart )
+
+    def test_pending( self ):
+        class DeclineUi:
+            def question_yn( self, pre_msg, msg, default = 'y' ):
+                return False
+
+        romobj = pyromanager.rom.Rom( 'tests/fake.nds', self.db, self.config )
+        self.assertEqual( romobj.local_info( interactive = False ), None )
+        self.db.add_pending( [ romobj.pending_info() ] )
+        self.assertEqual( len( self.db.pending_list() ), 1 )
+
+        pyromanager.rom.resolve_pending( self.db, self.config, DeclineUi() )
+        self.assertListEqual( self.db.pending_list(), [] )
+        self.assertTrue( self.db.already_in_local( romobj.path, 1 ) )
+
     def test_Nds( self ):
         testFile = pyromanager.rom.Nds( 'tests/TinyFB.nds' )
         testFile.parse()
@@ -200,6 +442,178 @@ class rom_test( unittest.TestCase ):
         self.assertEqual( testFile.hardware['encryption'] , 0 )
         self.assertEqual( testFile.hardware['capacity']   , 16 )
 
+    def test_find_file_dupes( self ):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data = open( 'tests/TinyFB.nds', 'rb' ).read()
+            for ( name, content ) in [ ( 'a.nds', data ), ( 'b.nds', data ),
+                    ( 'sub/c.nds', data ), ( 'd.nds', data[:-1] + 'X' ),
+                    ( 'e.nds', data[:100] + 'X' + data[101:] ),
+                    ( 'f.txt', data ), ( 'g.nds', 'tiny' ),
+                    ( 'h.nds', 'tiny' ) ]:
+                pyromanager.rom.mkdir( os.path.dirname( '%s/%s' % ( tmp_dir,
+                    name ) ) )
+                with open( '%s/%s' % ( tmp_dir, name ), 'wb' ) as fh:
+                    fh.write( content )
+
+            dupes = [ [ '%s/a.nds' % tmp_dir, '%s/b.nds' % tmp_dir,
+                '%s/sub/c.nds' % tmp_dir ], [ '%s/g.nds' % tmp_dir,
+                    '%s/h.nds' % tmp_dir ] ]
+            self.assertListEqual( pyromanager.rom.find_file_dupes( tmp_dir,
+                [ 'nds' ] ), dupes )
+            self.assertListEqual( pyromanager.rom.find_file_dupes( tmp_dir,
+                [ 'nds' ], chunk_size = 16 ), dupes )
+        finally:
+            shutil.rmtree( tmp_dir )
+
+    def test_missing_paths( self ):
+        present = [ 'tests/TinyFB.nds', 'tests/TinyFB.zip:TinyFB.nds' ]
+        missing = [ 'tests/gone.nds', 'tests/gone.zip:TinyFB.nds',
+                '/nonexistent/dir/gone.nds' ]
+        for jobs in ( 1, 2 ):
+            self.assertListEqual( sorted( pyromanager.rom.missing_paths(
+                present + missing, jobs ) ), sorted( missing ) )
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.symlink( '%s/loop' % tmp_dir, '%s/loop' % tmp_dir )
+            for jobs in ( 1, 2 ):
+                self.assertListEqual( pyromanager.rom.missing_paths( [
+                    '%s/loop/gone.nds' % tmp_dir ], jobs ), [] )
+        finally:
+            shutil.rmtree( tmp_dir )
+
+    def test_fingerprint( self ):
+        stat = pyromanager.rom.fingerprint( 'tests/TinyFB.zip:TinyFB.nds' )
+        self.assertEqual( stat[0:3], ( 'tests/TinyFB.zip', 'TinyFB.nds',
+            os.path.getsize( 'tests/TinyFB.zip' ) ) )
+        self.assertEqual( self.db.cached_crc( stat ), None )
+        self.db.add_fingerprints( [ stat + ( 352, 516824321L ) ] )
+        self.assertEqual( self.db.cached_crc( stat ), ( 352, 516824321L ) )
+        self.assertEqual( self.db.cached_crc( stat[0:2] + ( 1, ) + stat[3:] ),
+                None, 'Changed size' )
+        self.assertEqual( pyromanager.rom.fingerprint( 'tests/missing.nds' ),
+                None )
+
+        finfo = pyromanager.rom.FileInfo( 'tests/missing.nds',
+                self.config.tmp_dir )
+        finfo.init( ( 352, 516824321L ) )
+        self.assertTrue( finfo.is_valid() )
+        self.assertEqual( finfo.crc, 516824321L )
+
+    def test_stream_crc( self ):
+        file_handler = open( 'tests/TinyFB.nds', 'rb' )
+        self.assertTupleEqual( pyromanager.rom.stream_crc( file_handler,
+            chunk_size = 7 ), ( 0x1ece1d01, 352 ) )
+        file_handler.close()
+
+    def test_map_files( self ):
+        args = [ ( path, self.config.tmp_dir, False, None, None ) for path in (
+            'tests/TinyFB.nds', 'tests/TinyFB.zip:TinyFB.nds' ) ]
+        for processes in ( False, True ):
+            crcs = [ finfo.crc for finfo in pyromanager.rom.map_files(
+                pyromanager.rom.parse_file, args, 2, processes ) ]
+            self.assertListEqual( crcs, [ 516824321L, 516824321L ] )
+
+        groups = list( pyromanager.rom.group_candidates( args ) )
+        self.assertEqual( len( groups ), 2 )
+        self.assertEqual( pyromanager.rom.parse_files( groups[1] )[0].crc,
+                516824321L )
+
+    def test_parse_files_listed( self ):
+        tmp_dir = tempfile.mkdtemp()
+        scan_files = pyromanager.rom.Zip.scan_files
+        try:
+            zip_path = '%s/two.zip' % tmp_dir
+            archive = zipfile.ZipFile( zip_path, 'w' )
+            for name in ( 'a.nds', 'b.nds' ):
+                archive.write( 'tests/TinyFB.nds', name )
+            archive.close()
+
+            def no_scan( self, ext = 'nds' ):
+                raise AssertionError( 'archive listed again' )
+            pyromanager.rom.Zip.scan_files = no_scan
+            result = pyromanager.rom.parse_files( [ ( '%s:%s' % ( zip_path,
+                name ), self.config.tmp_dir, False, None, 352 ) for name in (
+                    'a.nds', 'b.nds' ) ] )
+            self.assertListEqual( [ finfo.crc for finfo in result ],
+                    [ 516824321L, 516824321L ] )
+        finally:
+            pyromanager.rom.Zip.scan_files = scan_files
+            shutil.rmtree( tmp_dir )
+
+    def test_pickle( self ):
+        finfo = pyromanager.rom.parse_file( ( 'tests/TinyFB.nds',
+            self.config.tmp_dir, False, None, None ) )
+        self.assertFalse( hasattr( finfo, '__dict__' ) )
+        copy = pickle.loads( pickle.dumps( finfo, 2 ) )
+        self.assertEqual( copy.crc, finfo.crc )
+        self.assertEqual( copy.nds.title, 'NDS.TinyFB' )
+        self.assertTupleEqual( copy.name_info, finfo.name_info )
+
+    def test_Archive_stream( self ):
+        class CatArchive( pyromanager.rom.Archive ):
+            def stream_command( self, archive_files ):
+                return [ 'cat' ] + archive_files
+
+        archive = CatArchive( 'tests/cat.7z' )
+        nds = archive.get_nds( 'tests/TinyFB.nds' )
+        self.assertTrue( nds.is_valid() )
+        self.assertEqual( nds.crc, 516824321L )
+        self.assertEqual( nds.size, 352 )
+        self.assertFalse( archive.get_nds( 'tests/missing.nds' ).is_valid() )
+        with open( os.devnull, 'wb' ) as file_handler:
+            self.assertTupleEqual( archive.copy_member( 'tests/TinyFB.nds',
+                file_handler ), ( 516824321L, 352 ) )
+            self.assertRaises( IOError, archive.copy_member,
+                    'tests/missing.nds', file_handler )
+
+        archive.file_list = [ 'tests/TinyFB.nds', 'tests/fake.nds' ]
+        archive.sizes = dict( ( name, os.path.getsize( name ) ) for name in
+                archive.file_list )
+        result = dict( archive.iter_nds( [ 'tests/fake.nds',
+            'tests/TinyFB.nds' ] ) )
+        self.assertEqual( result['tests/TinyFB.nds'].crc, 516824321L )
+        self.assertEqual( result['tests/fake.nds'].size,
+                os.path.getsize( 'tests/fake.nds' ) )
+
+        archive.sizes['tests/fake.nds'] -= 1
+        self.assertFalse( [ nds for ( name, nds ) in archive.iter_nds( [
+            'tests/fake.nds', 'tests/TinyFB.nds' ] ) if nds.is_valid() ] )
+        archive.sizes['tests/fake.nds'] += 1
+
+        class FailingArchive( CatArchive ):
+            def stream_command( self, archive_files ):
+                return [ 'sh', '-c', 'cat "$@"; exit 2', 'sh' ] + archive_files
+
+        archive = FailingArchive( 'tests/cat.7z' )
+        self.assertFalse( archive.get_nds( 'tests/TinyFB.nds' ).is_valid() )
+        archive.file_list = [ 'tests/TinyFB.nds', 'tests/fake.nds' ]
+        archive.sizes = dict( ( name, os.path.getsize( name ) ) for name in
+                archive.file_list )
+        self.assertFalse( [ nds for ( name, nds ) in archive.iter_nds( [
+            'tests/fake.nds', 'tests/TinyFB.nds' ] ) if nds.is_valid() ] )
+
+    def test_Archive_cached( self ):
+        archive = pyromanager.rom.Zip( 'tests/TinyFB.zip' )
+        archive.scan_files_cached( self.db )
+        self.assertListEqual( archive.file_list, [ 'TinyFB.nds' ] )
+        self.assertEqual( archive.crcs['TinyFB.nds'], 516824321L )
+
+        file_stat = pyromanager.rom.fingerprint( archive.path )
+        self.assertListEqual( self.db.archive_listing( archive.path,
+            file_stat[2], file_stat[3] ), [ ( 'TinyFB.nds', 352, 516824321L ) ] )
+        self.assertEqual( self.db.archive_listing( archive.path, 1,
+            file_stat[3] ), None, 'Changed archive' )
+        self.assertTupleEqual( pyromanager.rom.listed_known_crc(
+            '%s:TinyFB.nds' % archive.path, self.db ), ( 352, 516824321L ) )
+
+        self.db.store_archive_listing( archive.path, file_stat[2],
+                file_stat[3], [ ( 'Cached.nds', 1, 2 ) ] )
+        archive = pyromanager.rom.Zip( 'tests/TinyFB.zip' )
+        archive.scan_files_cached( self.db )
+        self.assertListEqual( archive.file_list, [ 'Cached.nds' ] )
+
     def test_parse_filename( self ):
         testNames = {
             "games/0028 - Kirby - Canvas Curse (EUR).NDS"      : ( 28, "kirby canvas curse", 0 ),
@@ -214,6 +628,8 @@ class rom_test( unittest.TestCase ):
         }
         for( fileName, expectedResult ) in testNames.iteritems():
             self.assertTupleEqual( pyromanager.rom.parse_filename( fileName ), expectedResult )
+        self.assertListEqual( pyromanager.rom.parse_filenames(
+            testNames.keys() ), testNames.values() )
 
     def test_extension( self ):
         self.assertEqual( pyromanager.rom.extension( 'path/to/somefile.wTf' ),
@@ -221,7 +637,12 @@ class rom_test( unittest.TestCase ):
 
     def test_search( self ):
         config = pyromanager.cfg.Config()
-        self.assertEqual( len( pyromanager.rom.search( '', config ) ), 3 )
+        self.assertEqual( len( list( pyromanager.rom.search( '', config ) ) ),
+                3 )
+        self.assertEqual( len( list( pyromanager.rom.search( '', config,
+            subdirs = False ) ) ), 0 )
+        self.assertEqual( len( list( pyromanager.rom.search( 'tests', config,
+            subdirs = False ) ) ), 3 )
 
 if __name__ == '__main__':
     unittest.main()